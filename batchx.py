@@ -0,0 +1,62 @@
+# Batch runs (`--batch').
+# Every script, or with `-' every line of the standard input, is a separate task. A task runs in a `fork'
+# of a warm image: an interpreter that has already loaded the prelude (`--prelude=FILE'), so the forms
+# of the prelude are parsed and compiled once per worker and not once per task.
+# The tasks run on a pool of `--jobs' processes. The outputs are printed in the order of the inputs,
+# the errors go to the standard error as `TASK: message'.
+
+batch_image: Interpreter | None = None
+
+def batch_init(prelude: str | None, opts: Dict[str, Any]) -> None:
+    """Builds the image of this process. With the `fork' start method the workers inherit the image of the parent."""
+    global batch_image
+    if batch_image is not None:
+        return
+    image = Interpreter()
+    for k, v in opts.items():
+        if k == "memo_size":
+            image.memo_cache.limit = v
+        else:
+            setattr(image, k, v)
+    if prelude is not None:
+        image.run_file(prelude)
+    batch_image = image
+
+def batch_task(task: Tuple[str, str | None]) -> Tuple[str, str, str | None]:
+    """Runs a script (its path and None) or a query (a name and the source). Returns the name, the output and the error."""
+    name, text = task
+    assert batch_image is not None
+    it = batch_image.fork()
+    out = io.StringIO()
+    try:
+        with redirect_stdout(out):
+            if text is None:
+                it.run_file(name)
+            else:
+                it.run_source(text, name)
+    except Exception as e:
+        return name, out.getvalue(), str(e)
+    return name, out.getvalue(), None
+
+def run_batch(tasks: List[Tuple[str, str | None]], prelude: str | None, opts: Dict[str, Any], jobs: int) -> bool:
+    """Returns False if some task failed."""
+    batch_init(prelude, opts)  # An error in the prelude is reported once, before any worker starts.
+    ok = True
+    results: Iterable[Tuple[str, str, str | None]]
+    if jobs <= 1:
+        results = map(batch_task, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs, batch_init, (prelude, opts))
+        results = pool.imap(batch_task, tasks, max(1, len(tasks) // (jobs * 8)))
+    try:
+        for name, out, err in results:
+            sys.stdout.write(out)
+            if err is not None:
+                sys.stdout.flush()
+                print(f"{name}: {err}", file=sys.stderr)
+                ok = False
+    finally:
+        if jobs > 1:
+            pool.close()
+            pool.join()
+    return ok
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# Benchmarks of the interpreter.
+# Runs the shipped programs and generated workloads of several sizes with the built `main.py' (see build.sh)
+# and reports the wall time, the number of rewrites and the peak memory of every run.
+#
+#   python3 bench.py [--main=main.py] [--args="--eval=stack"] [--repeat=N] [--timeout=S]
+#                    [--only=NAME,...] [--json=FILE] [--baseline=FILE] [--tolerance=0.2]
+#   python3 bench.py --engines [--main=main.py] [--args="--eval=stack"] [--timeout=S] [--only=NAME,...]
+#
+# `--json' saves the results, `--baseline' compares them with saved ones: a run that got slower
+# or bigger by more than the tolerance, or that does a different number of rewrites, is flagged
+# and the exit code is 1.
+# `--engines' benchmarks nothing: it runs every shipped `*.mfl' with `--engine=generic' and with
+# `--engine=codegen' and compares the outputs, the generic matcher is the reference for the compiled one.
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import *
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# name, size, script (a path in the repo or a generated source), how many output lines to wait for (0 - all)
+Workload = Tuple[str, str, str, int]
+
+def shipped() -> List[Workload]:
+    return [
+        ("fib.mfl", "-", "fib.mfl", 0),
+        ("peano.mfl", "-", "peano.mfl", 0),
+        ("tc_proof.mfl", "20 rows", "tc_proof.mfl", 20),  # It never stops.
+        ("fsm.mfl", "-", "fsm.mfl", 0),
+        ("props.mfl", "-", "props.mfl", 0),
+    ]
+
+def gen_fib(n: int) -> str:
+    return f"""
+form sum: (A add (s B)) -> sum[((s sum[A]) add sum[B])]
+form sum: (A add 0)     -> A
+form sum: (A add B)     -> sum[(sum[A] add sum[B])]
+form sum: A             -> A
+form fib: 0             -> 0
+form fib: (s 0)         -> (s 0)
+form fib: (s (s N))     -> sum[(fib[(s N)] add fib[N])]
+let x = fib[_TOPEANO[{n}]]
+show _INCLVL[x]
+"""
+
+def gen_rule110(width: int, steps: int) -> str:
+    """The Rule 110 automaton of tc_proof.mfl on a row of `width' cells, unrolled for `steps' rows."""
+    src = open(os.path.join(REPO, "tc_proof.mfl")).read()
+    rules = src[:src.index("func f")]
+    state = "()"
+    for i in range(width):
+        state = f"({state} {1 if i == width - 3 else 0})"
+    body = "    let A = iter[A]\n" * (width - 3)
+    return rules + f"""
+func f = (A) {{
+{body}    let Result = otoi[A]
+    let Result = ((first[first[Result]] 0) second[Result])
+    show lm2pt[(first[Result] 1)]
+}}
+let st = {state}
+""" + "let st = f[(st)]\n" * steps
+
+def gen_tuple(n: int) -> str:
+    """`_SI'/`_GI'/`_CONCAT' on a tuple of `n' elements."""
+    lines = ["let t = (" + " ".join("0" for _ in range(n)) + ")"]
+    for k in range(0, n, max(1, n // 200)):
+        lines.append(f"let t = _SI[(t {k} 1)]")
+        lines.append(f"let x = _GI[(t {k})]")
+    lines.append("let u = _CONCAT[(t t)]")
+    lines.append("show _LENGTH[u]")
+    return "\n".join(lines) + "\n"
+
+def gen_rules(r: int) -> str:
+    """One transformation with `r' rules, called 500 times."""
+    lines = [f"form big: (k{i} X) -> (v{i} X)" for i in range(r)]
+    lines.append("form big: X -> none")
+    for j in range(500):
+        lines.append(f"let x = big[(k{(j * 7919) % (r + 1)} a)]")
+    lines.append("show x")
+    return "\n".join(lines) + "\n"
+
+def generated() -> List[Workload]:
+    w: List[Workload] = []
+    for n in (5, 10, 15, 20):
+        w.append(("fib", f"n={n}", gen_fib(n), 0))
+    for width, steps in ((16, 16), (32, 32), (64, 64)):
+        w.append(("rule110", f"{width}x{steps}", gen_rule110(width, steps), 0))
+    for n in (1000, 4000, 16000):
+        w.append(("tuple", f"n={n}", gen_tuple(n), 0))
+    for r in (100, 400):
+        w.append(("rules", f"r={r}", gen_rules(r), 0))
+    return w
+
+def run(cmd: List[str], limit: int, timeout: float) -> Tuple[str, float, int, str]:
+    """Runs `cmd' in the repo until it exits, prints `limit' lines or times out.
+    Returns the status, the wall time, the peak RSS in KB and the last line of stderr."""
+    with tempfile.TemporaryFile("w+") as err:
+        t0 = time.perf_counter()
+        p = subprocess.Popen(cmd, cwd=REPO, stdout=subprocess.PIPE, stderr=err, text=True)
+        timer = threading.Timer(timeout, p.kill)
+        timer.start()
+        status = "ok"
+        lines = 0
+        assert p.stdout is not None
+        for _ in p.stdout:
+            lines += 1
+            if limit and lines >= limit:
+                p.send_signal(signal.SIGINT)  # Not `kill', so `--profile' still writes its results.
+                break
+        p.stdout.close()
+        _, ws, ru = os.wait4(p.pid, 0)
+        wall = time.perf_counter() - t0
+        p.returncode = os.waitstatus_to_exitcode(ws)
+        timer.cancel()
+        if not (limit and lines >= limit) and p.returncode != 0:
+            status = "timeout" if wall >= timeout else "error"
+        err.seek(0)
+        last = (err.read().strip().split("\n") or [""])[-1]
+    return status, wall, ru.ru_maxrss, last
+
+def bench(w: Workload, main: str, args: List[str], repeat: int, timeout: float, tmp: str) -> Dict[str, Any]:
+    name, size, script, limit = w
+    if script.endswith(".mfl"):
+        path = script
+    else:
+        path = os.path.join(tmp, f"{name}-{size}.mfl".replace("=", ""))
+        with open(path, "w") as f:
+            f.write(script)
+    res: Dict[str, Any] = {"name": name, "size": size}
+    if limit:
+        args = args + ["--flush=line"]  # The lines must come as they're shown, not in blocks.
+    best = None
+    for _ in range(repeat):
+        status, wall, rss, last = run([sys.executable, main] + args + [path], limit, timeout)
+        if status != "ok":
+            res.update(status=status, error=last)
+            return res
+        if best is None or wall < best[0]:
+            best = (wall, rss)
+    assert best is not None
+    prof = os.path.join(tmp, "profile.json")
+    if os.path.exists(prof):
+        os.remove(prof)
+    run([sys.executable, main] + args + [f"--profile={prof}", path], limit, timeout)
+    rewrites = calls = 0
+    if os.path.exists(prof):
+        for r in json.load(open(prof)):
+            if r["kind"] == "form" and not r["name"].endswith("`"):
+                rewrites += r["hits"]
+            elif r["kind"] in ("func", "builtin"):
+                calls += r["calls"]
+    res.update(status="ok", time=best[0], peak_kb=best[1], rewrites=rewrites, calls=calls)
+    return res
+
+def output(cmd: List[str], limit: int, timeout: float) -> Tuple[List[str], str]:
+    """The first `limit' lines (all of them if 0) that `cmd' prints and the last line of its stderr."""
+    with tempfile.TemporaryFile("w+") as err:
+        p = subprocess.Popen(cmd, cwd=REPO, stdout=subprocess.PIPE, stderr=err, text=True)
+        timer = threading.Timer(timeout, p.kill)
+        timer.start()
+        lines: List[str] = []
+        assert p.stdout is not None
+        for l in p.stdout:
+            lines.append(l)
+            if limit and len(lines) >= limit:
+                p.kill()
+                break
+        p.stdout.close()
+        p.wait()
+        timer.cancel()
+        err.seek(0)
+        last = (err.read().strip().split("\n") or [""])[-1]
+    return lines, last
+
+def engines(main: str, args: List[str], timeout: float, only: List[str] | None) -> int:
+    """Runs the shipped programs with both rule engines. Returns 1 if any output differs."""
+    limits = {w[2]: w[3] for w in shipped()}
+    limits["looping.mfl"] = 1000  # It never stops either, it's compared on its first lines.
+    bad = 0
+    for p in sorted(i for i in os.listdir(REPO) if i.endswith(".mfl")):
+        if only is not None and p not in only:
+            continue
+        limit = limits.get(p, 0)
+        flush = ["--flush=line"] if limit else []
+        a = output([sys.executable, main] + args + flush + ["--engine=generic", p], limit, timeout)
+        b = output([sys.executable, main] + args + flush + ["--engine=codegen", p], limit, timeout)
+        if a == b:
+            print(f"{p:<20} same ({len(a[0])} lines)", flush=True)
+            continue
+        bad = 1
+        n = next((i for i, (x, y) in enumerate(zip(a[0], b[0])) if x != y), min(len(a[0]), len(b[0])))
+        print(f"{p:<20} DIFFERENT at line {n + 1}", flush=True)
+        print(f"  generic: {a[0][n].rstrip() if n < len(a[0]) else a[1]}")
+        print(f"  codegen: {b[0][n].rstrip() if n < len(b[0]) else b[1]}")
+    return bad
+
+def compare(res: List[Dict[str, Any]], base: List[Dict[str, Any]], tol: float) -> List[str]:
+    old = {(b["name"], b["size"]): b for b in base}
+    flags = []
+    for r in res:
+        b = old.get((r["name"], r["size"]))
+        if b is None or b["status"] != "ok":
+            continue
+        what = f"{r['name']} {r['size']}"
+        if r["status"] != "ok":
+            flags.append(f"{what}: {r['status']} ({r.get('error', '')})")
+            continue
+        if r["time"] > b["time"] * (1 + tol):
+            flags.append(f"{what}: {r['time']:.3f}s instead of {b['time']:.3f}s (+{(r['time'] / b['time'] - 1) * 100:.0f}%)")
+        if r["peak_kb"] > b["peak_kb"] * (1 + tol):
+            flags.append(f"{what}: {r['peak_kb']} KB instead of {b['peak_kb']} KB")
+        if r["rewrites"] != b["rewrites"]:
+            flags.append(f"{what}: {r['rewrites']} rewrites instead of {b['rewrites']}")
+    return flags
+
+def main() -> int:
+    usage = f"{sys.argv[0]}: Usage: [--engines] [--main=FILE] [--args=ARGS] [--repeat=N] [--timeout=S] [--only=NAME,...] [--json=FILE] [--baseline=FILE] [--tolerance=X]"
+    main_py = os.path.join(REPO, "main.py")
+    args = ["--eval=stack"]
+    repeat = 3
+    timeout = 120.0
+    only: List[str] | None = None
+    out: str | None = None
+    baseline: str | None = None
+    tol = 0.2
+    check_engines = False
+    for a in sys.argv[1:]:
+        k, _, v = a.partition("=")
+        if k == "--main":
+            main_py = os.path.abspath(v)
+        elif k == "--args":
+            args = v.split()
+        elif k == "--repeat" and v.isdigit():
+            repeat = max(1, int(v))
+        elif k == "--timeout":
+            timeout = float(v)
+        elif k == "--only":
+            only = v.split(",")
+        elif k == "--json":
+            out = v
+        elif k == "--baseline":
+            baseline = v
+        elif k == "--tolerance":
+            tol = float(v)
+        elif a == "--engines":
+            check_engines = True
+        else:
+            print(usage, file=sys.stderr)
+            return 1
+    if not os.path.exists(main_py):
+        print(f"{main_py} doesn't exist, run build.sh first", file=sys.stderr)
+        return 1
+    if check_engines:
+        return engines(main_py, args, timeout, only)
+    res = []
+    print(f"{'benchmark':<14} {'size':<10} {'time s':>9} {'rewrites':>10} {'calls':>8} {'peak KB':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for w in shipped() + generated():
+            if only is not None and w[0] not in only:
+                continue
+            r = bench(w, main_py, args, repeat, timeout, tmp)
+            res.append(r)
+            if r["status"] == "ok":
+                print(f"{r['name']:<14} {r['size']:<10} {r['time']:>9.3f} {r['rewrites']:>10} {r['calls']:>8} {r['peak_kb']:>9}", flush=True)
+            else:
+                print(f"{r['name']:<14} {r['size']:<10} {r['status']}: {r['error']}", flush=True)
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump({"args": args, "results": res}, f, indent=1)
+    if baseline is not None:
+        with open(baseline) as b:
+            flags = compare(res, json.load(b)["results"], tol)
+        for flag in flags:
+            print(f"REGRESSION {flag}")
+        if flags:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,20 @@ from dataclasses import dataclass
 from copy import deepcopy
 from typing import *
 from enum import Enum
+import weakref
+from collections import OrderedDict
+from array import array
+import re
+import mmap
+import locale
+import os
+import hashlib
+import pickle
+import json
+from time import perf_counter_ns
+from contextlib import redirect_stdout
+import io
+import multiprocessing
 
 # TO NOT BE CONFUSED, `SExpr' is a purely logic type, when `Expr' is a purely parsing type.
 
@@ -55,9 +69,32 @@ class PeekableSequence(Peekable, Generic[T]):
     
     def next(self) -> T | None:
         self.qi += 1
+        self.c = None
         return self.peek()
     def peek(self) -> T | None:
-        return self.seq[self.qi] if self.qi < len(self.seq) else None
+        if self.c is None and self.qi < len(self.seq):
+            self.c = self.seq[self.qi]
+        return self.c
+
+class PeekableIterator(Peekable, Generic[T]):
+    it: Iterator[T]
+    started: bool
+    c: T | None
+
+    def __init__(self, it: Iterator[T]) -> None:
+        self.it = it
+        self.started = False
+        self.c = None
+
+    def next(self) -> T | None:
+        self.peek()
+        self.c = next(self.it, None)
+        return self.c
+    def peek(self) -> T | None:
+        if not self.started:
+            self.started = True
+            self.c = next(self.it, None)
+        return self.c
 
 @dataclass
 class Token:
@@ -69,6 +106,61 @@ class Token:
 
 NITOK = Token(TokenKind.EOF, -1, -1, "<>")
 
+token_kinds = list(TokenKind)
+
+# Paths of the lexed files, `TokenBuffer' keeps only an index into this table.
+source_files: List[str] = []
+source_file_ids: Dict[str, int] = {}
+
+def file_id(filepath: str) -> int:
+    i = source_file_ids.get(filepath)
+    if i is None:
+        i = source_file_ids[filepath] = len(source_files)
+        source_files.append(filepath)
+    return i
+
+class TokenBuffer(Sequence[Token]):
+    """The tokens of one file as a struct of arrays. A `Token' is made only when it's accessed."""
+    fid: int
+    kinds: 'array[int]'
+    rows: 'array[int]'
+    cols: 'array[int]'
+    syms: 'array[int]'  # An index into `strs' or -1.
+    strs: List[str]
+    str_ids: Dict[str, int]
+
+    def __init__(self, filepath: str) -> None:
+        self.fid = file_id(filepath)
+        self.kinds = array('B')
+        self.rows = array('l')
+        self.cols = array('l')
+        self.syms = array('l')
+        self.strs = []
+        self.str_ids = {}
+
+    def add(self, kind: TokenKind, row: int, col: int, sym: str | None = None) -> None:
+        self.kinds.append(kind.value)
+        self.rows.append(row)
+        self.cols.append(col)
+        if sym is None:
+            self.syms.append(-1)
+            return
+        i = self.str_ids.get(sym)
+        if i is None:
+            i = self.str_ids[sym] = len(self.strs)
+            self.strs.append(sym)
+        self.syms.append(i)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, i: int) -> Token:  # type: ignore[override]
+        if i < 0:
+            i += len(self.kinds)
+        k = self.kinds[i]
+        s = self.syms[i]
+        return Token(token_kinds[k], self.rows[i], self.cols[i], source_files[self.fid], self.strs[s] if s >= 0 else None)
+
 @dataclass
 class Expr:
     token: Token
@@ -95,22 +187,431 @@ class ExprQuote(Expr):
 class ExprTuple(Expr):
     el: List[Expr]
 
-@dataclass
-class SExpr(Expr):
-    wr: bool
+# `SExpr' terms are hash-consed: structurally equal terms are one shared object,
+# so `==' is an identity check and `hash' is O(1). Terms are immutable and don't
+# carry tokens, the location of the first equal term built from source is kept in `sexpr_locs'.
+# Every term also knows whether it contains calls that are still to be evaluated (`pending'),
+# so the evaluators skip resolved subterms without scanning them, and its size as a tree (`size').
+
+sexpr_locs: 'weakref.WeakKeyDictionary[SExpr, Token]' = weakref.WeakKeyDictionary()
+
+class SExpr:
+    __slots__ = ("__weakref__",)
+    pending: bool
+    size: int
+
+    @property
+    def token(self) -> Token:
+        return sexpr_locs.get(self, NITOK)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"`{type(self).__name__}' is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"`{type(self).__name__}' is immutable")
+
+    def __copy__(self) -> 'SExpr':
+        return self
+
+    def __deepcopy__(self, memo: Any) -> 'SExpr':
+        return self
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({stringify(self)!r})"
+
+# Intern tables hold the terms weakly, a term is dropped as soon as nobody uses it.
+_symbols: Dict[str, 'weakref.KeyedRef'] = {}
+_calls: Dict[Tuple[str, SExpr], 'weakref.KeyedRef'] = {}
+_tuples: Dict[Tuple[SExpr, ...], 'weakref.KeyedRef'] = {}
+
+def _interned(table: Dict[Any, 'weakref.KeyedRef']) -> Callable[['weakref.KeyedRef'], None]:
+    def gone(ref: 'weakref.KeyedRef') -> None:
+        if table.get(ref.key) is ref:
+            del table[ref.key]
+    return gone
+
+_symbol_gone = _interned(_symbols)
+_call_gone = _interned(_calls)
+_tuple_gone = _interned(_tuples)
+
+# Symbols of `ROPE_MIN' or more characters are also interned by their length and a hash of their
+# text. The hash of a concatenation is computed from the hashes of its parts, so `_CONCAT' can build
+# a `SExprRope' without building its text and still find the equal symbol if there is one.
+ROPE_MIN = 64
+_TEXT_P = (1 << 61) - 1
+_long_symbols: Dict[Tuple[int, int], 'weakref.KeyedRef'] = {}
+_long_symbol_gone = _interned(_long_symbols)
+
+def _text_key(s: str) -> Tuple[int, int]:
+    # The characters are digits in base 2**32, modulo the prime 2**61 - 1.
+    return len(s), int.from_bytes(s.encode("utf-32-be", "surrogatepass"), "big") % _TEXT_P
 
-@dataclass
 class SExprSymbol(SExpr):
-    sym: str
+    __slots__ = ("sym", "var")
+    if TYPE_CHECKING:  # Read-only, so `SExprRope' can make it a property
+        @property
+        def sym(self) -> str: ...
+    var: bool  # Whether it's a pattern variable: starts with an uppercase letter.
+    pending = False
+    size = 1
+
+    def __new__(cls, sym: str, token: Token | None = None) -> 'SExprSymbol':
+        r = _symbols.get(sym)
+        e = r() if r is not None else None
+        if e is None and len(sym) >= ROPE_MIN:
+            k = _text_key(sym)
+            r = _long_symbols.get(k)
+            e = r() if r is not None else None
+            if e is not None and e.sym != sym:  # Only the hashes are equal
+                e = None
+            elif e is None:
+                e = object.__new__(cls)
+                object.__setattr__(e, "sym", sym)
+                object.__setattr__(e, "var", sym[:1].isupper())
+                _symbols[sym] = weakref.KeyedRef(e, _symbol_gone, sym)
+                _long_symbols[k] = weakref.KeyedRef(e, _long_symbol_gone, k)
+        if e is None:
+            e = object.__new__(cls)
+            object.__setattr__(e, "sym", sym)
+            object.__setattr__(e, "var", sym[:1].isupper())
+            _symbols[sym] = weakref.KeyedRef(e, _symbol_gone, sym)
+        if token is not None and e not in sexpr_locs:
+            sexpr_locs[e] = token
+        return e
+
+    def __reduce__(self) -> Any:
+        return (SExprSymbol, (self.sym,))
 
-@dataclass
 class SExprCall(SExpr):
+    __slots__ = ("fun", "arg", "size")
     fun: str
     arg: SExpr
+    pending = True
+
+    def __new__(cls, fun: str, arg: SExpr, token: Token | None = None) -> 'SExprCall':
+        k = (fun, arg)
+        r = _calls.get(k)
+        e = r() if r is not None else None
+        if e is None:
+            e = object.__new__(cls)
+            object.__setattr__(e, "fun", fun)
+            object.__setattr__(e, "arg", arg)
+            object.__setattr__(e, "size", 1 + arg.size)
+            _calls[k] = weakref.KeyedRef(e, _call_gone, k)
+        if token is not None and e not in sexpr_locs:
+            sexpr_locs[e] = token
+        return e
+
+    def __reduce__(self) -> Any:
+        return (SExprCall, (self.fun, self.arg))
 
-@dataclass
 class SExprTuple(SExpr):
-    el: List[SExpr]
+    __slots__ = ("el", "pending", "size")
+    if TYPE_CHECKING:  # Read-only, so `SExprPeano' and `SExprVector' can make it a property
+        @property
+        def el(self) -> Tuple[SExpr, ...]: ...
+    pending: bool
+
+    def __new__(cls, el: Iterable[SExpr], token: Token | None = None) -> 'SExprTuple':
+        k = tuple(el)
+        if len(k) == 2 and k[0] is PEANO_S and (k[1] is PEANO_ZERO or isinstance(k[1], SExprPeano)):
+            return SExprPeano(k[1].n + 1 if isinstance(k[1], SExprPeano) else 1, token)
+        if len(k) >= VECTOR_MIN:
+            return SExprVector(_vec_build(k), len(k), token)
+        r = _tuples.get(k)
+        e = r() if r is not None else None
+        if e is None:
+            e = object.__new__(cls)
+            object.__setattr__(e, "el", k)
+            object.__setattr__(e, "pending", any(i.pending for i in k))
+            object.__setattr__(e, "size", 1 + sum(i.size for i in k))
+            _tuples[k] = weakref.KeyedRef(e, _tuple_gone, k)
+        if token is not None and e not in sexpr_locs:
+            sexpr_locs[e] = token
+        return e
+
+    def __reduce__(self) -> Any:
+        return (SExprTuple, (self.el,))
+
+# A Peano numeral `(s (s ... 0))' is stored as its count: it's O(1) in size and `el' is built on demand.
+# `SExprTuple' turns every `(s N)' with a numeral or `0' as `N' into a `SExprPeano', so the two forms
+# are never different terms, and for the rest of the interpreter a numeral is an ordinary 2-tuple.
+_numerals: Dict[int, 'weakref.KeyedRef'] = {}
+_numeral_gone = _interned(_numerals)
+
+class SExprPeano(SExprTuple):
+    __slots__ = ("n", "_el")
+    n: int
+    _el: Tuple[SExpr, ...] | None
+    pending = False
+
+    def __new__(cls, n: int, token: Token | None = None) -> 'SExprPeano':  # type: ignore[misc]
+        assert n > 0
+        r = _numerals.get(n)
+        e = r() if r is not None else None
+        if e is None:
+            e = object.__new__(cls)
+            object.__setattr__(e, "n", n)
+            object.__setattr__(e, "_el", None)
+            object.__setattr__(e, "size", 2 * n + 1)
+            _numerals[n] = weakref.KeyedRef(e, _numeral_gone, n)
+        if token is not None and e not in sexpr_locs:
+            sexpr_locs[e] = token
+        return e
+
+    @property
+    def el(self) -> Tuple[SExpr, ...]:
+        # Kept once built: a match usually looks at the same numeral several times.
+        # Only the numerals that were actually peeled stay alive.
+        el = self._el
+        if el is None:
+            el = (PEANO_S, SExprPeano(self.n - 1) if self.n > 1 else PEANO_ZERO)
+            object.__setattr__(self, "_el", el)
+        return el
+
+    def __reduce__(self) -> Any:
+        return (SExprPeano, (self.n,))
+
+PEANO_S = SExprSymbol("s")
+PEANO_ZERO = SExprSymbol("0")
+
+# A tuple of `VECTOR_MIN' or more elements is a `SExprVector': a persistent vector, a trie of
+# `_VEC_WIDTH'-wide nodes whose leaves hold the elements in order. The shape of the trie depends
+# only on the length and the nodes are hash-consed too, so equal tuples are still one object.
+# `tuple_get', `tuple_set' and `tuple_concat' copy only the path to the leaves they touch,
+# the rest is shared with the old tuple, which stays valid. `el' is a read-only view of the elements.
+VECTOR_MIN = 64
+_VEC_BITS = 5
+_VEC_WIDTH = 1 << _VEC_BITS
+_VEC_MASK = _VEC_WIDTH - 1
+
+class _VecNode:
+    __slots__ = ("kids", "pending", "size", "__weakref__")
+    kids: Tuple[Any, ...]
+    pending: bool
+    size: int
+
+_vec_nodes: Dict[Tuple[Any, ...], 'weakref.KeyedRef'] = {}
+_vec_node_gone = _interned(_vec_nodes)
+_vectors: Dict[Tuple[_VecNode, int], 'weakref.KeyedRef'] = {}
+_vector_gone = _interned(_vectors)
+
+def _vec_node(kids: Tuple[Any, ...]) -> _VecNode:
+    r = _vec_nodes.get(kids)
+    e = r() if r is not None else None
+    if e is None:
+        e = _VecNode()
+        e.kids = kids
+        e.pending = any(i.pending for i in kids)
+        e.size = sum(i.size for i in kids)
+        _vec_nodes[kids] = weakref.KeyedRef(e, _vec_node_gone, kids)
+    return e
+
+def _vec_shift(n: int) -> int:
+    shift = 0
+    while n > _VEC_WIDTH << shift:
+        shift += _VEC_BITS
+    return shift
+
+def _vec_build(k: Tuple[SExpr, ...]) -> _VecNode:
+    level = [_vec_node(k[i:i + _VEC_WIDTH]) for i in range(0, len(k), _VEC_WIDTH)]
+    while len(level) > 1:
+        level = [_vec_node(tuple(level[i:i + _VEC_WIDTH])) for i in range(0, len(level), _VEC_WIDTH)]
+    return level[0]
+
+def _vec_set(node: _VecNode, shift: int, i: int, v: Any) -> _VecNode:
+    """Replaces the element `i' (a leaf when `shift' is 0 and a node otherwise) below `node'."""
+    j = (i >> shift) & _VEC_MASK
+    if shift:
+        v = _vec_set(node.kids[j], shift - _VEC_BITS, i, v)
+    return _vec_node(node.kids[:j] + (v,) + node.kids[j + 1:])
+
+def _vec_put(node: _VecNode | None, shift: int, i: int, leaf: _VecNode) -> _VecNode:
+    """Puts `leaf' as the leaf holding the element `i' below `node', `None' is a path that doesn't exist yet."""
+    kids = node.kids if node is not None else ()
+    j = (i >> shift) & _VEC_MASK
+    if shift > _VEC_BITS:
+        leaf = _vec_put(kids[j] if j < len(kids) else None, shift - _VEC_BITS, i, leaf)
+    return _vec_node(kids[:j] + (leaf,) + kids[j + 1:])
+
+def _vec_iter(node: _VecNode, shift: int) -> Iterator[SExpr]:
+    if not shift:
+        yield from node.kids
+    else:
+        for i in node.kids:
+            yield from _vec_iter(i, shift - _VEC_BITS)
+
+def _vec_reversed(node: _VecNode, shift: int) -> Iterator[SExpr]:
+    if not shift:
+        yield from reversed(node.kids)
+    else:
+        for i in reversed(node.kids):
+            yield from _vec_reversed(i, shift - _VEC_BITS)
+
+class SExprVector(SExprTuple):
+    __slots__ = ("n", "root", "shift")
+    n: int
+    root: _VecNode
+    shift: int
+
+    def __new__(cls, root: _VecNode, n: int, token: Token | None = None) -> 'SExprVector':  # type: ignore[misc]
+        k = (root, n)
+        r = _vectors.get(k)
+        e = r() if r is not None else None
+        if e is None:
+            e = object.__new__(cls)
+            object.__setattr__(e, "n", n)
+            object.__setattr__(e, "root", root)
+            object.__setattr__(e, "shift", _vec_shift(n))
+            object.__setattr__(e, "pending", root.pending)
+            object.__setattr__(e, "size", 1 + root.size)
+            _vectors[k] = weakref.KeyedRef(e, _vector_gone, k)
+        if token is not None and e not in sexpr_locs:
+            sexpr_locs[e] = token
+        return e
+
+    @property
+    def el(self) -> 'VectorView':  # type: ignore[override]  # Indexed and iterated like the tuple
+        return VectorView(self)
+
+    def get(self, i: int) -> SExpr:
+        node = self.root
+        shift = self.shift
+        while shift:
+            node = node.kids[(i >> shift) & _VEC_MASK]
+            shift -= _VEC_BITS
+        return node.kids[i & _VEC_MASK]
+
+    def extend(self, items: Iterable[SExpr]) -> 'SExprVector':
+        k = tuple(items)
+        root = self.root
+        shift = self.shift
+        n = self.n
+        j = 0
+        if n & _VEC_MASK and k:  # Fill up the last leaf first
+            node = root
+            for s in range(shift, 0, -_VEC_BITS):
+                node = node.kids[((n - 1) >> s) & _VEC_MASK]
+            j = _VEC_WIDTH - len(node.kids)
+            root = _vec_put(root, shift, n - 1, _vec_node(node.kids + k[:j]))
+            n += len(k[:j])
+        for j in range(j, len(k), _VEC_WIDTH):
+            leaf = _vec_node(k[j:j + _VEC_WIDTH])
+            if n == _VEC_WIDTH << shift:  # The trie is full, it becomes the first child of a new root
+                shift += _VEC_BITS
+                root = _vec_node((root,))
+            root = _vec_put(root, shift, n, leaf)
+            n += len(leaf.kids)
+        return SExprVector(root, n)
+
+    def __reduce__(self) -> Any:
+        return (SExprTuple, (tuple(self.el),))
+
+class VectorView:
+    """The elements of a `SExprVector', indexed in O(log n)."""
+    __slots__ = ("v",)
+
+    def __init__(self, v: SExprVector) -> None:
+        self.v = v
+
+    def __len__(self) -> int:
+        return self.v.n
+
+    def __getitem__(self, i: Any) -> Any:
+        if isinstance(i, slice):
+            return tuple(self)[i]
+        if i < 0:
+            i += self.v.n
+        if not 0 <= i < self.v.n:
+            raise IndexError("tuple index out of range")
+        return self.v.get(i)
+
+    def __iter__(self) -> Iterator[SExpr]:
+        return _vec_iter(self.v.root, self.v.shift)
+
+    def __reversed__(self) -> Iterator[SExpr]:
+        return _vec_reversed(self.v.root, self.v.shift)
+
+def tuple_set(t: SExprTuple, i: int, v: SExpr) -> SExprTuple:
+    """`t' with the element `i' replaced by `v', `v' is appended if `i' is past the end."""
+    if not isinstance(t, SExprVector):
+        return SExprTuple(t.el[:i] + (v,) + t.el[i + 1:])
+    if i >= t.n:
+        return t.extend((v,))
+    return SExprVector(_vec_set(t.root, t.shift, i, v), t.n)
+
+def tuple_concat(a: SExprTuple, b: SExprTuple) -> SExprTuple:
+    if isinstance(a, SExprVector):
+        return a.extend(b.el)
+    return SExprTuple(a.el + tuple(b.el))
+
+# A symbol built by `_CONCAT' is a `SExprRope' when it's long: the two symbols it's made of. Its text is
+# joined the first time `sym' is used, so a symbol built one character at a time is O(n) to print.
+# Ropes are interned like the other symbols (see `ROPE_MIN'), a rope and a symbol with the same text
+# are never different terms, and `==' on them is still an identity check.
+class SExprRope(SExprSymbol):
+    __slots__ = ("left", "right", "n", "h", "_sym")
+    left: SExprSymbol
+    right: SExprSymbol
+    n: int
+    h: int
+    _sym: str | None
+
+    def __new__(cls, left: SExprSymbol, right: SExprSymbol) -> SExprSymbol:  # type: ignore[misc]
+        ln, lh = _symbol_key(left)
+        rn, rh = _symbol_key(right)
+        k = (ln + rn, (lh * pow(2, 32 * rn % 61, _TEXT_P) + rh) % _TEXT_P)  # 2**61 is 1 modulo the prime
+        r = _long_symbols.get(k)
+        e = r() if r is not None else None
+        if e is not None:
+            if isinstance(e, SExprRope) and e.left is left and e.right is right or e.sym == left.sym + right.sym:
+                return e
+            return SExprSymbol(left.sym + right.sym)
+        e = object.__new__(cls)
+        object.__setattr__(e, "left", left)
+        object.__setattr__(e, "right", right)
+        object.__setattr__(e, "var", left.var)
+        object.__setattr__(e, "n", k[0])
+        object.__setattr__(e, "h", k[1])
+        object.__setattr__(e, "_sym", None)
+        _long_symbols[k] = weakref.KeyedRef(e, _long_symbol_gone, k)
+        return e
+
+    @property
+    def sym(self) -> str:
+        s = self._sym
+        if s is None:
+            parts: List[str] = []
+            todo: List[SExprSymbol] = [self]
+            while todo:
+                e = todo.pop()
+                if isinstance(e, SExprRope) and e._sym is None:
+                    todo.append(e.right)
+                    todo.append(e.left)
+                else:
+                    parts.append(e.sym)
+            s = ''.join(parts)
+            object.__setattr__(self, "_sym", s)
+            r = _symbols.get(s)
+            if r is None or r() is None:
+                _symbols[s] = weakref.KeyedRef(self, _symbol_gone, s)
+        return s
+
+def _symbol_key(e: SExprSymbol) -> Tuple[int, int]:
+    return (e.n, e.h) if isinstance(e, SExprRope) else _text_key(e.sym)
+
+def symbol_length(e: SExprSymbol) -> int:
+    return e.n if isinstance(e, SExprRope) else len(e.sym)
+
+def symbol_concat(a: SExprSymbol, b: SExprSymbol) -> SExprSymbol:
+    n = symbol_length(a) + symbol_length(b)
+    if n < ROPE_MIN:
+        return SExprSymbol(a.sym + b.sym)
+    if n == symbol_length(a):
+        return a
+    if n == symbol_length(b):
+        return b
+    return SExprRope(a, b)
 
 @dataclass
 class Stmt:
@@ -145,14 +646,175 @@ class StmtShow(Stmt):
 class StmtPrint(Stmt):
     text: str
 
+@dataclass
+class StmtMemo(Stmt):
+    name: str
+    on: bool
+
+@dataclass
+class StmtRepeat(Stmt):
+    count: Expr
+    body: List[Stmt]
+
+@dataclass
+class StmtFix(Stmt):
+    name: str
+    expr: Expr
+
+def write_term(expr: SExpr, out: List[str], spill: Callable[[], None] | None = None) -> None:
+    """Appends the text of `expr' to `out' piece by piece. `spill' is called when `out' gets long, it may empty it."""
+    todo: List[SExpr | str] = [expr]
+    while todo:
+        e = todo.pop()
+        if isinstance(e, str):
+            out.append(e)
+        elif isinstance(e, SExprSymbol):
+            out.append(e.sym)
+        elif isinstance(e, SExprPeano):
+            out.append("(s " * e.n + "0" + ")" * e.n)
+        elif isinstance(e, SExprTuple):
+            out.append('(')
+            todo.append(')')
+            first = True
+            for i in reversed(e.el):
+                if not first:
+                    todo.append(' ')
+                todo.append(i)
+                first = False
+        elif isinstance(e, SExprCall):
+            out.append(e.fun + '[')
+            todo.append(']')
+            todo.append(e.arg)
+        else:
+            assert False, "unreachable"
+        if spill is not None and len(out) >= 4096:
+            spill()
+
 def stringify(expr: SExpr) -> str:
-    if isinstance(expr, SExprSymbol):
-        return expr.sym
-    elif isinstance(expr, SExprTuple):
-        return '(' + ' '.join(stringify(i) for i in expr.el) + ')'
-    elif isinstance(expr, SExprCall):
-        return expr.fun + '[' + stringify(expr.arg) + ']'
-    assert False, "unreachable"
+    out: List[str] = []
+    write_term(expr, out)
+    return ''.join(out)
+
+# A compact serialization of terms for sending them between processes.
+# The term is a postorder list of codes `payload << 3 | kind':
+#   T_SYM  - the symbol strs[payload],
+#   T_CALL - the call of strs[payload], its argument is the last node,
+#   T_TUP  - a tuple of the last `payload' nodes,
+#   T_NUM  - the numeral `payload',
+#   T_REF  - the node number `payload' again (shared subterms are written once).
+# The nodes are numbered in the order they are written, T_REF and T_SYM don't get numbers.
+T_SYM, T_CALL, T_TUP, T_NUM, T_REF = range(5)
+
+def encode_term(expr: SExpr) -> Tuple[List[str], bytes]:
+    strs: List[str] = []
+    str_ids: Dict[str, int] = {}
+    codes = array('q')
+    seen: Dict[int, int] = {}
+    todo: List[Any] = [expr]
+    while todo:
+        e = todo.pop()
+        if isinstance(e, tuple):  # (node, kind, payload) after its children
+            seen[id(e[0])] = len(seen)
+            codes.append(e[2] << 3 | e[1])
+            continue
+        if isinstance(e, SExprSymbol):
+            i = str_ids.get(e.sym)
+            if i is None:
+                i = str_ids[e.sym] = len(strs)
+                strs.append(e.sym)
+            codes.append(i << 3 | T_SYM)
+            continue
+        n = seen.get(id(e))
+        if n is not None:
+            codes.append(n << 3 | T_REF)
+        elif isinstance(e, SExprPeano):
+            seen[id(e)] = len(seen)
+            codes.append(e.n << 3 | T_NUM)
+        elif isinstance(e, SExprTuple):
+            todo.append((e, T_TUP, len(e.el)))
+            todo.extend(reversed(e.el))
+        elif isinstance(e, SExprCall):
+            i = str_ids.get(e.fun)
+            if i is None:
+                i = str_ids[e.fun] = len(strs)
+                strs.append(e.fun)
+            todo.append((e, T_CALL, i))
+            todo.append(e.arg)
+        else:
+            assert False, "unreachable"
+    # The codes are stored in the smallest type that holds them, its code is the first byte.
+    top = max(codes, default=0)
+    tc = 'B' if top < 1 << 8 else 'H' if top < 1 << 16 else 'I' if top < 1 << 32 else 'q'
+    return strs, tc.encode() + array(tc, codes).tobytes()
+
+def decode_term(data: Tuple[List[str], bytes]) -> SExpr:
+    strs, raw = data
+    codes = array(chr(raw[0]))
+    codes.frombytes(raw[1:])
+    vals: List[SExpr] = []
+    nodes: List[SExpr] = []
+    for c in codes:
+        kind, p = c & 7, c >> 3
+        if kind == T_SYM:
+            vals.append(SExprSymbol(strs[p]))
+            continue
+        if kind == T_REF:
+            vals.append(nodes[p])
+            continue
+        if kind == T_CALL:
+            e: SExpr = SExprCall(strs[p], vals.pop())
+        elif kind == T_TUP:
+            e = SExprTuple(vals[len(vals) - p:])
+            del vals[len(vals) - p:]
+        else:
+            e = SExprPeano(p)
+        nodes.append(e)
+        vals.append(e)
+    return vals[0]
+
+# Records of the binary output (`--output=binary'), every record starts with its kind:
+#   b"T" - a term: u32 count of strings, each as u32 length + UTF-8, u32 length + the codes of `encode_term',
+#   b"P" - a text of `print': u32 length + UTF-8.
+# The numbers are little-endian.
+
+def _u32(n: int) -> bytes:
+    return n.to_bytes(4, "little")
+
+def term_record(expr: SExpr) -> bytes:
+    strs, codes = encode_term(expr)
+    parts = [b"T", _u32(len(strs))]
+    for i in strs:
+        b = i.encode()
+        parts.append(_u32(len(b)))
+        parts.append(b)
+    parts.append(_u32(len(codes)))
+    parts.append(codes)
+    return b"".join(parts)
+
+def text_record(text: str) -> bytes:
+    b = text.encode()
+    return b"P" + _u32(len(b)) + b
+
+def read_records(f: BinaryIO) -> Iterator[SExpr | str]:
+    """Reads the records written by `--output=binary', the terms are returned as terms and the texts as strings."""
+    def take(n: int) -> bytes:
+        b = f.read(n)
+        if len(b) != n:
+            raise EOFError("Truncated record")
+        return b
+    def u32() -> int:
+        return int.from_bytes(take(4), "little")
+    while True:
+        kind = f.read(1)
+        if not kind:
+            return
+        if kind == b"P":
+            yield take(u32()).decode()
+        elif kind == b"T":
+            strs = [take(u32()).decode() for _ in range(u32())]
+            yield decode_term((strs, take(u32())))
+        else:
+            raise ValueError(f"Unknown record kind {kind!r}")
 
 iota(True)
 class LocFmtStyle(Enum):
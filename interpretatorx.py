@@ -1,74 +1,509 @@
+_ABSENT = object()
+_DELETED = object()
+
+class CowMap:
+    """A copy-on-write dictionary. `copy' is O(1): the copy reads through to its parent and keeps only its own changes.
+    Before the parent changes an entry, the old value is pushed down to its live copies, so a copy stays a snapshot."""
+    __slots__ = ("own", "parent", "children", "__weakref__")
+    own: Dict[str, Any]
+    parent: 'CowMap | None'
+    children: 'weakref.WeakSet[CowMap] | None'
+
+    def __init__(self, parent: 'CowMap | None' = None) -> None:
+        self.own = {}
+        self.parent = parent
+        self.children = None
+        if parent is not None:
+            if parent.children is None:
+                parent.children = weakref.WeakSet()
+            parent.children.add(self)
+
+    def copy(self) -> 'CowMap':
+        return CowMap(self)
+
+    def inherit(self, value: Any) -> Any:
+        """Maps a value seen through the parent."""
+        return value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        v = self.own.get(key, _ABSENT)
+        if v is _ABSENT:
+            if self.parent is None:
+                return default
+            v = self.parent.get(key, _ABSENT)
+            return default if v is _ABSENT else self.inherit(v)
+        return default if v is _DELETED else v
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _ABSENT) is not _ABSENT
+
+    def __getitem__(self, key: str) -> Any:
+        v = self.get(key, _ABSENT)
+        if v is _ABSENT:
+            raise KeyError(key)
+        return v
+
+    def _detach(self, key: str) -> None:
+        if self.children:
+            old = self.get(key, _DELETED)
+            for c in self.children:
+                if key not in c.own:
+                    c.own[key] = old if old is _DELETED else c.inherit(old)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._detach(key)
+        self.own[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._detach(key)
+        if self.parent is not None and key in self.parent:
+            self.own[key] = _DELETED
+        else:
+            del self.own[key]
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        seen: Set[str] = set()
+        m: CowMap | None = self
+        while m is not None:
+            seen.update(m.own)
+            m = m.parent
+        for k in seen:
+            v = self.get(k, _ABSENT)
+            if v is not _ABSENT:
+                yield k, v
+
+class FunctionMap(CowMap):
+    """A copy of a function table in which the inherited functions see snapshots of the contexts they captured.
+    The functions that captured `home' see `home_symbols' and this table, so a snapshot doesn't refer to itself."""
+    __slots__ = ("remap", "home", "home_symbols")
+    remap: Dict[int, Tuple['Context', 'Context']]
+    home: 'Context | None'
+    home_symbols: 'CowMap | None'
+
+    def __init__(self, parent: 'CowMap | None' = None, remap: Dict[int, Tuple['Context', 'Context']] | None = None,
+                 home: 'Context | None' = None, home_symbols: 'CowMap | None' = None) -> None:
+        super().__init__(parent)
+        self.remap = remap or {}
+        self.home = home
+        self.home_symbols = home_symbols
+
+    def copy(self) -> 'CowMap':
+        return FunctionMap(self)
+
+    def inherit(self, value: Any) -> Any:
+        if value[3] is self.home:
+            return (value[0], value[1], value[2], Context(cast(CowMap, self.home_symbols), self, True))
+        r = self.remap.get(id(value[3]))
+        if r is None or r[0] is not value[3]:
+            return value
+        return (value[0], value[1], value[2], r[1])
+
+# A call frame is a `clone' of the context the function was defined in.
+# Cloning is O(1) in the number of symbols: the frame holds only the arguments and the symbols set in it,
+# and the contexts captured by the visible functions are snapshotted the same way.
+# A snapshot (`frozen') never changes, so only the contexts that can change are snapshotted: the inherited
+# functions of a table see snapshots already, only its own entries can capture the others (`captured').
 @dataclass
 class Context:
-    symbols: Dict[str, Tuple[SExpr, Union[Token, None]]]
-    functions: Dict[str, Tuple[Token, List[str], List[Stmt], 'Context']]
+    symbols: CowMap  # str -> Tuple[SExpr, Token | None]
+    functions: CowMap  # str -> Tuple[Token, List[str], List[Stmt], Context]
+    frozen: bool = False
+    # `captured' without this context, and whether it's captured too, as of `functions_version'.
+    captures: 'List[Context] | None' = None
+    captures_self: bool = False
+    captures_version: int = -1
+
+    functions_version: ClassVar[int] = 0  # Bumped by `set_function' and `del_function'.
+
+    def captured(self) -> List['Context']:
+        if self.frozen:
+            return []
+        if self.captures_version != Context.functions_version:
+            r: Dict[int, Context] = {}
+            for f in self.functions.own.values():
+                if f is not _DELETED and not f[3].frozen:
+                    r[id(f[3])] = f[3]
+            self.captures_self = r.pop(id(self), None) is not None
+            self.captures = list(r.values())
+            self.captures_version = Context.functions_version
+        assert self.captures is not None
+        return [self, *self.captures] if self.captures_self else self.captures
+
     def clone(self) -> 'Context':
-        return Context(deepcopy(self.symbols), deepcopy(self.functions))
+        snaps: Dict[int, Tuple[Context, Context]] = {}
+        todo = [self]
+        while todo:
+            for d in todo.pop().captured():
+                if id(d) not in snaps:
+                    symbols = d.symbols.copy()
+                    snaps[id(d)] = (d, Context(symbols, FunctionMap(d.functions, None, d, symbols), True))
+                    todo.append(d)
+        if len(snaps) > 1:
+            for d, c in snaps.values():
+                cast(FunctionMap, c.functions).remap = {k: v for k, v in snaps.items() if v[0] is not d}
+        return Context(self.symbols.copy(), FunctionMap(self.functions, snaps))
+
+class MemoCache:
+    """A LRU cache of evaluated calls."""
+    limit: int
+    data: 'OrderedDict[Any, SExpr]'
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.data = OrderedDict()
+
+    def get(self, key: Any) -> SExpr | None:
+        v = self.data.get(key)
+        if v is not None:
+            self.data.move_to_end(key)
+        return v
+
+    def put(self, key: Any, value: SExpr) -> None:
+        self.data[key] = value
+        if len(self.data) > self.limit:
+            self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        self.data.clear()
+
+# The output of `show' and `print'. It's collected in `parts' and written to `sys.stdout' when there's
+# more than `limit' characters (`flush_mode' "block") or after every statement ("line"), and at the end of a run.
+# A big term is written while it's serialized, it's never one string. Output formats:
+#   text   - the terms as in the source, one per line,
+#   lp     - every line is prefixed with its length in bytes and ":" (`12:(a (s 0) b)'),
+#   binary - `term_record' and `text_record' (see `read_records').
+
+class OutputSink:
+    fmt: str
+    flush_mode: str
+    limit: int
+    parts: List[Any]
+    size: int
+    flushes: int
+
+    def __init__(self, fmt: str = "text", flush_mode: str = "block", limit: int = 1 << 13) -> None:
+        self.fmt = fmt
+        self.flush_mode = flush_mode
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.flushes = 0
+
+    def show(self, e: SExpr) -> None:
+        if self.fmt == "binary":
+            self.add(term_record(e))
+        elif self.fmt == "lp":
+            self.line(stringify(e))
+        else:
+            k = self.flushes
+            n = len(self.parts)
+            write_term(e, self.parts, self.spill)
+            self.parts.append("\n")
+            self.size += sum(len(i) for i in self.parts[n if k == self.flushes else 0:])
+            self.check()
+
+    def text(self, t: str) -> None:
+        if self.fmt == "binary":
+            self.add(text_record(t))
+        elif self.fmt == "lp":
+            self.line(t)
+        else:
+            self.add(t + "\n")
+
+    def line(self, t: str) -> None:
+        self.add(f"{len(t.encode())}:{t}\n")
+
+    def add(self, p: Any) -> None:
+        self.parts.append(p)
+        self.size += len(p)
+        self.check()
+
+    def check(self) -> None:
+        if self.size >= self.limit or self.flush_mode == "line":
+            self.flush()
+
+    def spill(self) -> None:
+        """Called by `write_term' while a big term is written."""
+        if len(self.parts) >= 4096:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.parts:
+            if self.fmt == "binary":
+                sys.stdout.flush()
+                sys.stdout.buffer.write(b"".join(self.parts))
+                sys.stdout.buffer.flush()
+            else:
+                sys.stdout.write("".join(self.parts))
+                if self.flush_mode == "line":
+                    sys.stdout.flush()
+            self.parts.clear()
+            self.flushes += 1
+        self.size = 0
+
+# The state of a run: the forms, the global context, the options, the caches and the hooks.
+# The parser (`form', `include') and the evaluator work on the active interpreter `ip'.
+# `fork' makes a warm copy of a loaded rule set: the rule lists and their nets are shared
+# until one side defines more forms with the same name, the symbols and the functions are a `clone'.
+
+class Interpreter:
+    meta_transformations: Dict[str, List[Tuple[SExpr, SExpr]]]
+    transformations: Dict[str, List[Tuple[SExpr, SExpr, Token]]]
+    # Compiled rule lists, kept in sync with the tables above by `form' and `unlink'.
+    meta_transformation_nets: Dict[str, 'RuleNet']
+    transformation_nets: Dict[str, 'RuleNet']
+    shared_forms: Set[str]  # Names whose rule lists are shared with the interpreter this one was forked from.
+    ctx_glbl: Context
+    ctx_list: List[Context]
+    rule_engine: str
+    evaluator: str
+    memo_default: bool
+    memo_pragmas: Dict[str, bool]
+    memo_cache: MemoCache
+    memo_epoch: int
+    purity: Dict[str, bool]
+    profiler: 'Profiler | None'
+    tracer: 'Tracer | None'
+    include_cache: bool
+    include_once: bool
+    included: Set[str]  # Real paths of the files loaded in this run.
+    include_recorders: List['IncludeRecord']
+    out: OutputSink
+    lazy: bool
+    thunks: MemoCache
+    parallel: int  # The number of worker processes, 0 - the tuples are evaluated inline.
+    parallel_min: int
+    portable: Dict[str, bool]
+    pool: Any
+    pool_version: int
+    forms_version: int
+    targets: Dict[str, Tuple[int, Any]]  # See `call_target'.
+    function_names: Set[str]  # Every name a function was defined with.
+
+    def __init__(self) -> None:
+        self.meta_transformations = {}
+        self.transformations = {}
+        self.meta_transformation_nets = {}
+        self.transformation_nets = {}
+        self.shared_forms = set()
+        self.ctx_glbl = Context(CowMap(), CowMap())
+        self.ctx_list = []
+        self.rule_engine = "generic"
+        self.evaluator = "recursive"
+        self.memo_default = False
+        self.memo_pragmas = {}
+        self.memo_cache = MemoCache(1 << 16)
+        self.memo_epoch = 0
+        self.purity = {}
+        self.profiler = None
+        self.tracer = None
+        self.include_cache = False
+        self.include_once = False
+        self.included = set()
+        self.include_recorders = []
+        self.out = OutputSink()
+        self.lazy = False
+        self.thunks = MemoCache(1 << 16)
+        self.parallel = 0
+        self.parallel_min = 32
+        self.portable = {}
+        self.pool = None
+        self.pool_version = -1
+        self.forms_version = 0
+        self.targets = {}
+        self.function_names = set()
+
+    def fork(self) -> 'Interpreter':
+        """A copy that can load and run more code without changing this one. It's O(number of names)."""
+        r = Interpreter()
+        r.meta_transformations = dict(self.meta_transformations)
+        r.transformations = dict(self.transformations)
+        r.meta_transformation_nets = dict(self.meta_transformation_nets)
+        r.transformation_nets = dict(self.transformation_nets)
+        r.shared_forms = set(self.meta_transformations) | set(self.transformations)
+        # The parent must not append to the lists it gave away either.
+        self.shared_forms = set(r.shared_forms)
+        r.ctx_glbl = self.ctx_glbl.clone()
+        r.rule_engine = self.rule_engine
+        r.evaluator = self.evaluator
+        r.memo_default = self.memo_default
+        r.memo_pragmas = dict(self.memo_pragmas)
+        r.memo_cache.limit = self.memo_cache.limit
+        r.lazy = self.lazy
+        r.include_cache = self.include_cache
+        r.include_once = self.include_once
+        r.included = set(self.included)
+        r.function_names = set(self.function_names)
+        r.out = OutputSink(self.out.fmt, self.out.flush_mode, self.out.limit)
+        return r
+
+    def close(self) -> None:
+        """Stops the worker processes of `--parallel'."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def activate(self) -> 'Interpreter':
+        """Makes this interpreter the active one and returns the previous one."""
+        global ip
+        prev = ip
+        ip = self
+        return prev
+
+    def parse(self, text: str, filepath: str) -> List[Stmt]:
+        prev = self.activate()
+        try:
+            return parse_program(ParseEnv(PeekableSequence(lexer(text, filepath))))
+        finally:
+            prev.activate()
+
+    def run(self, prog: Iterable[Stmt]) -> None:
+        prev = self.activate()
+        try:
+            interpret_stream(prog)
+        finally:
+            self.out.flush()
+            prev.activate()
+
+    def run_source(self, text: str, filepath: str) -> None:
+        """Parses and runs a whole script, its forms are visible to all of its statements."""
+        self.run(self.parse(text, filepath))
 
-meta_transformations: Dict[str, List[Tuple[SExpr, SExpr]]] = {}
-transformations: Dict[str, List[Tuple[SExpr, SExpr, Token]]] = {}
-ctx_glbl = Context({}, {})
-ctx_list: List[Context] = []
+    def run_file(self, path: str) -> None:
+        self.run_source(read_source(path), path)
+
+# Memoization of transformation and function calls.
+# It's enabled for a name by `memo NAME' (or for all the names by `--memo') and disabled by `nomemo NAME'.
+# A memoized call is evaluated eagerly: its argument and its result are resolved completely.
+# Only pure names are memoized: calls of `_LET' or of functions with side effects aren't cached.
+# A `let' in a function body writes the global symbol of its name if there's one, so it's a side effect
+# then, and a new global symbol can make an old function impure: it drops the purities that are known.
+# The functions read global symbols, so the results of the names whose call graph reaches a function are
+# keyed by `memo_epoch' too, the others don't see the symbols and are kept across the global writes.
+
+def forget_memo() -> None:
+    """Must be called after any change of the transformations."""
+    ip.memo_cache.clear()
+    ip.purity.clear()
+    ip.portable.clear()
+    ip.thunks.clear()
+    ip.targets.clear()
+    ip.forms_version += 1
+
+def forget_purity() -> None:
+    """Must be called after a change of a function body or of the global names: the purities depend on them."""
+    ip.purity.clear()
+    ip.targets.clear()
 
 def get_context() -> Context:
-    if ctx_list:
-        return ctx_list[-1]
-    return ctx_glbl
+    if ip.ctx_list:
+        return ip.ctx_list[-1]
+    return ip.ctx_glbl
 
 def get_symbol(name: str) -> Tuple[SExpr, Token | None] | None:
-    if ctx_list and name in ctx_list[-1].symbols:
-        return ctx_list[-1].symbols[name]
-    if name in ctx_glbl.symbols:
-        return ctx_glbl.symbols[name]
-    return None
+    if ip.ctx_list:
+        s = ip.ctx_list[-1].symbols.get(name)
+        if s is not None:
+            return s
+    return ip.ctx_glbl.symbols.get(name)
 
 def set_symbol(name: str, value: Tuple[SExpr, Token | None]) -> None:
-    if ctx_list and not name in ctx_glbl.symbols:
-        ctx_list[-1].symbols[name] = value
+    if ip.ctx_list and not name in ip.ctx_glbl.symbols:
+        ip.ctx_list[-1].symbols[name] = value
         return None
-    ctx_glbl.symbols[name] = value
+    if name not in ip.ctx_glbl.symbols:
+        forget_purity()
+    ip.ctx_glbl.symbols[name] = value
+    ip.memo_epoch += 1
 
 def del_symbol(name: str) -> None:
-    if ctx_list and name in ctx_list[-1].symbols:
-        del ctx_list[-1].symbols[name]
+    if ip.ctx_list and name in ip.ctx_list[-1].symbols:
+        del ip.ctx_list[-1].symbols[name]
         return None
-    del ctx_glbl.symbols[name]
+    del ip.ctx_glbl.symbols[name]
+    forget_purity()
+    ip.memo_epoch += 1
+
+# Call targets. The kind of a name is resolved on its first call and kept in `ip.targets':
+#   (K_TRANSFORM, net) - a transformation,
+#   (K_MEMO, None)     - a memoized transformation,
+#   (K_FUNCTION, b)    - a function was defined with this name, it's looked up in the context of the call
+#                        and the builtin `b' (or None) is called if it isn't visible there,
+#   (K_BUILTIN, b)     - the builtin `b',
+#   (K_UNKNOWN, None)  - nothing.
+# `forget_memo', `set_function' and the memo pragmas drop the kinds they change.
+K_TRANSFORM, K_MEMO, K_FUNCTION, K_BUILTIN, K_UNKNOWN = range(5)
+
+def call_target(name: str) -> Tuple[int, Any]:
+    t = ip.targets.get(name)
+    if t is None:
+        if name in ip.transformations:
+            t = (K_MEMO, None) if memo_enabled(name) else (K_TRANSFORM, ip.transformation_nets[name])
+        elif name in ip.function_names:
+            t = (K_FUNCTION, builtin_funcs.get(name))
+        elif name in builtin_funcs:
+            t = (K_BUILTIN, builtin_funcs[name])
+        else:
+            t = (K_UNKNOWN, None)
+        ip.targets[name] = t
+    return t
 
 def get_function(name: str) -> Tuple[Token, List[str], List[Stmt], Context] | None:
-    if ctx_list and name in ctx_list[-1].functions:
-        return ctx_list[-1].functions[name]
-    if name in ctx_glbl.functions:
-        return ctx_glbl.functions[name]
-    return None
+    if ip.ctx_list:
+        f = ip.ctx_list[-1].functions.get(name)
+        if f is not None:
+            return f
+    return ip.ctx_glbl.functions.get(name)
 
 def set_function(name: str, value: Tuple[Token, List[str], List[Stmt], Context]) -> None:
-    if ctx_list and not name in ctx_glbl.functions:
-        ctx_list[-1].functions[name] = value
+    """The results of the functions are keyed by `memo_epoch', the transformations aren't forgotten.
+    A local `func' that is defined again on every call with the same body keeps the purities."""
+    Context.functions_version += 1
+    ip.memo_epoch += 1
+    old = get_function(name)
+    if name not in ip.function_names:
+        ip.function_names.add(name)
+        ip.portable.clear()
+    if old is None or old[2] is not value[2]:
+        forget_purity()
+    if ip.ctx_list and not name in ip.ctx_glbl.functions:
+        ip.ctx_list[-1].functions[name] = value
         return
-    ctx_glbl.functions[name] = value
+    ip.ctx_glbl.functions[name] = value
 
 def del_function(name: str) -> None:
-    if ctx_list and name in ctx_list[-1].functions:
-        del ctx_list[-1].functions[name]
+    Context.functions_version += 1
+    ip.memo_epoch += 1
+    forget_purity()
+    if ip.ctx_list and name in ip.ctx_list[-1].functions:
+        del ip.ctx_list[-1].functions[name]
         return
-    del ctx_glbl.functions[name]
+    del ip.ctx_glbl.functions[name]
 
 def interpret_expr(e: Expr, comptime: bool = False, tok: Token | None = None) -> SExpr:
+    if ip.evaluator == "stack":
+        return run_machine([(W_EXPR, e, comptime, tok)])
     if isinstance(e, ExprSymbol):
         if not comptime:
             s = get_symbol(e.sym)
             if s:
                 return s[0]
-        return SExprSymbol(e.token, False, e.sym)
+        return SExprSymbol(e.sym, e.token)
     if isinstance(e, ExprCall):
         if comptime:
             return expr_to_sexpr(e)
-        if e.fun in transformations:
-            t = [(a[0],a[1]) for a in transformations[e.fun]]
-            return substitute_compatible(interpret_expr(e.arg), t, tok)
-        f = get_function(e.fun)
+        kind, target = call_target(e.fun)
+        if kind == K_MEMO:
+            return memo_transform(e.fun, interpret_expr(e.arg), tok)
+        if kind == K_TRANSFORM:
+            if ip.lazy:
+                return lazy_force(SExprCall(e.fun, expr_thunk(e.arg)), tok)
+            return substitute_compatible(interpret_expr(e.arg), target, tok)
+        f = get_function(e.fun) if kind == K_FUNCTION else None
         if f:
-            ctx_list.append(f[3].clone())
+            ip.ctx_list.append(f[3].clone())
             _args = e.arg
             if not isinstance(_args, ExprTuple):
                 raise RuntimeError(f"Expr kind {type(_args)} doesn't supported by functions at {format_loc(tok) if tok else 'Somewhere'}")
@@ -77,55 +512,46 @@ def interpret_expr(e: Expr, comptime: bool = False, tok: Token | None = None) ->
             if len(args) != l:
                 raise RuntimeError(f"Expected {l} arguments but got {len(args)} arguments at {format_loc(tok) if tok else 'Somewhere'}")
             for i in range(l):
-                ctx_list[-1].symbols[f[1][i]] = interpret_expr(args[i], comptime, tok), args[i].token
-            for p in f[2]:
-                interpret_stmt(p)
-            r = get_symbol("Result")
-            ctx_list.pop()
-            if r is None:
-                return SExprSymbol(tok if tok is not None else NITOK, False, "NIL")
-            return r[0]
-        if e.fun in builtin_funcs:
-            return builtin_funcs[e.fun](BuiltinFunc_Args(e, comptime, tok))
+                ip.ctx_list[-1].symbols[f[1][i]] = interpret_expr(args[i], comptime, tok), args[i].token
+            return run_function(e.fun, f, tok)
+        if target is not None:
+            return call_builtin(e, comptime, tok)
         raise RuntimeError(f"Unknown transformation or builtin function `{e.fun}' at {format_loc(tok) if tok else 'Somewhere'}")
     if isinstance(e, ExprCTCall):
         if comptime:
-            if e.fun in meta_transformations:
-                t = meta_transformations[e.fun]
-                return substitute_compatible(interpret_expr(e.arg), t, tok)
+            if e.fun in ip.meta_transformations:
+                return substitute_compatible(interpret_expr(e.arg), ip.meta_transformation_nets[e.fun], tok)
             if e.fun in builtin_funcs:
-                return builtin_funcs[e.fun](BuiltinFunc_Args(e, comptime, tok))
+                return call_builtin(e, comptime, tok)
             raise RuntimeError(f"Unknown meta-transformation or builtin function `{e.fun}' at {format_loc(tok) if tok else 'Somewhere'}")
         raise RuntimeError(f"CT-Call is avaliable only at transformation definition at {format_loc(tok) if tok else 'Somewhere'}")
     if isinstance(e, ExprTuple):
-        return SExprTuple(e.token, False, [interpret_expr(i, comptime, tok) for i in e.el])
+        return SExprTuple([interpret_expr(i, comptime, tok) for i in e.el], e.token)
     if isinstance(e, ExprQuote):
         return expr_to_sexpr(e.sentence)
     assert False, f"Unreachable: {e}"
 
 def is_unresolved(e: SExpr) -> bool:
-
-    if isinstance(e, SExprSymbol):
-        return False
-    if isinstance(e, SExprCall):
-        return True
-    if isinstance(e, SExprTuple):
-        return any(is_unresolved(i) for i in e.el)
-    assert False, f"Unreachable: {e}"
+    return e.pending
 
 def interpret_sexpr(e: SExpr, comptime: bool = False, tok: Token | None = None) -> SExpr:
+    if ip.evaluator == "stack":
+        return run_machine([(W_SEXPR, e, comptime, tok)])
     if isinstance(e, SExprSymbol):
         return e
     if isinstance(e, SExprCall):
         if comptime:
             return e
-        if e.fun in transformations:
-            t = [(a[0],a[1]) for a in transformations[e.fun]]
-            e = substitute_compatible(interpret_sexpr(e.arg), t, tok)
-            return e
-        f = get_function(e.fun)
+        kind, target = call_target(e.fun)
+        if kind == K_MEMO:
+            return memo_transform(e.fun, e.arg, tok)
+        if kind == K_TRANSFORM:
+            if ip.lazy:
+                return lazy_force(e, tok)
+            return substitute_compatible(interpret_sexpr(e.arg), target, tok)
+        f = get_function(e.fun) if kind == K_FUNCTION else None
         if f:
-            ctx_list.append(f[3].clone())
+            ip.ctx_list.append(f[3].clone())
             _args = e.arg
             if not isinstance(_args, SExprTuple):
                 raise RuntimeError(f"SExpr kind {type(_args)} doesn't supported by functions at {format_loc(tok) if tok else 'Somewhere'}")
@@ -134,33 +560,888 @@ def interpret_sexpr(e: SExpr, comptime: bool = False, tok: Token | None = None)
             if len(args) != l:
                 raise RuntimeError(f"Expected {l} arguments but got {len(args)} arguments at {format_loc(tok) if tok else 'Somewhere'}")
             for i in range(l):
-                ctx_list[-1].symbols[f[1][i]] = interpret_sexpr(args[i], comptime, tok), args[i].token
-            for p in f[2]:
-                interpret_stmt(p)
-            r = get_symbol("Result")
-            ctx_list.pop()
-            if r is None:
-                return SExprSymbol(tok if tok is not None else NITOK, False, "NIL")
-            return r[0]
-        if e.fun in builtin_funcs:
-            return builtin_funcs[e.fun](BuiltinFunc_Args(e, comptime, tok))
+                ip.ctx_list[-1].symbols[f[1][i]] = interpret_sexpr(args[i], comptime, tok), args[i].token
+            return run_function(e.fun, f, tok)
+        if target is not None:
+            return call_builtin(e, comptime, tok)
         raise RuntimeError(f"Unknown transformation or builtin function `{e.fun}' at {format_loc(tok) if tok else 'Somewhere'}")
     if isinstance(e, SExprTuple):
-        return SExprTuple(e.token, False, [interpret_sexpr(i) for i in e.el])
+        if not e.pending:
+            return e
+        return SExprTuple([interpret_sexpr(i) for i in e.el])
     assert False, f"Unreachable: {e}"
 
 def interpret_expr_extra(e: Expr, comptime: bool = False, tok: Token | None = None) -> SExpr:
-    s = interpret_expr(e, comptime, tok)
-    while is_unresolved(s):
-        s = interpret_sexpr(s, comptime, tok)
-    return s
+    if ip.evaluator == "stack":
+        return run_machine([(W_RESOLVE, comptime, tok), (W_EXPR, e, comptime, tok)])
+    return resolve_loop(interpret_expr(e, comptime, tok), comptime, tok)
 
 def interpret_sexpr_extra(e: SExpr, comptime: bool = False, tok: Token | None = None) -> SExpr:
-    s: SExpr = interpret_sexpr(s, comptime, tok)
+    if ip.evaluator == "stack":
+        return run_machine([(W_RESOLVE, comptime, tok), (W_SEXPR, e, comptime, tok)])
+    return resolve_loop(e, comptime, tok)
+
+def resolve_loop(s: SExpr, comptime: bool, tok: Token | None) -> SExpr:
+    """Evaluates `s' again until it has no calls. A pure term that comes back means an endless loop (see `Cycles')."""
+    if not is_unresolved(s):
+        return s
+    if ip.lazy and not comptime and is_pure_sexpr(s, set()):
+        return lazy_resolve(parallel_resolve(s, tok) if ip.parallel else s, tok)
+    c: Cycles | None = Cycles(s)
     while is_unresolved(s):
-        s = interpret_sexpr(s, comptime, tok)
+        s = interpret_sexpr(parallel_resolve(s, tok) if ip.parallel and not comptime else s, comptime, tok)
+        if c is not None and c.add(s):
+            check_cycle(c, lambda x: interpret_sexpr(x, comptime, tok), tok)
+            c = None
     return s
 
+def run_function(name: str, f: Tuple[Token, List[str], List[Stmt], Context], tok: Token | None) -> SExpr:
+    """Runs the body of `f' in the frame on top of `ctx_list' (the arguments are bound already) and pops the frame."""
+    key, c = function_enter(name, f)
+    if c is not None:
+        return c
+    epoch = ip.memo_epoch
+    t0 = perf_counter_ns() if ip.profiler is not None else 0
+    for p in f[2]:
+        interpret_stmt(p)
+    if ip.profiler is not None:
+        ip.profiler.call("func", name, perf_counter_ns() - t0)
+    return function_result(name, key, epoch, tok)
+
+def function_memo_key(name: str, f: Tuple[Token, List[str], List[Stmt], Context]) -> Any:
+    if memo_enabled(name) and f is ip.ctx_glbl.functions.get(name):
+        return (name, tuple(ip.ctx_list[-1].symbols[a][0] for a in f[1]), ip.memo_epoch)
+    return None
+
+def function_enter(name: str, f: Tuple[Token, List[str], List[Stmt], Context]) -> Tuple[Any, SExpr | None]:
+    """Starts the call of `f' in the frame on top of `ctx_list'. Returns the memo key and the cached result,
+    if there's a cached result the frame is popped already."""
+    key = function_memo_key(name, f)
+    if ip.tracer is not None:
+        ip.tracer.emit(TraceEvent("enter", name, -1, SExprTuple(ip.ctx_list[-1].symbols[a][0] for a in f[1])))
+    if key is not None:
+        c = ip.memo_cache.get(key)
+        if c is not None:
+            ip.ctx_list.pop()
+            if ip.tracer is not None:
+                ip.tracer.emit(TraceEvent("exit", name, -1, None, c))
+            return key, c
+    return key, None
+
+def function_result(name: str, key: Any, epoch: int, tok: Token | None) -> SExpr:
+    """Takes `Result' from the frame on top of `ctx_list' and pops the frame."""
+    r = get_symbol("Result")
+    ip.ctx_list.pop()
+    res = SExprSymbol("NIL", tok) if r is None else r[0]
+    if key is not None and epoch == ip.memo_epoch:  # The body didn't change any global symbol.
+        ip.memo_cache.put(key, res)
+    if ip.tracer is not None:
+        ip.tracer.emit(TraceEvent("exit", name, -1, None, res))
+    return res
+
+# Evaluators:
+#   recursive - `interpret_expr' and `interpret_sexpr' recurse on the Python stack,
+#   stack     - `run_machine' keeps the pending work on an explicit stack, so the depth of the terms
+#               and of the function calls is limited only by memory.
+# Both evaluate the subterms and run the statements in the same order.
+
+# Work items of `run_machine'. The first element of an item is its opcode.
+W_EXPR    = 0   # (W_EXPR, Expr, comptime, tok)       - `interpret_expr'
+W_SEXPR   = 1   # (W_SEXPR, SExpr, comptime, tok)     - `interpret_sexpr'
+W_TUPLE   = 2   # (W_TUPLE, n, token)                 - packs the last n values into a tuple
+W_APPLY   = 3   # (W_APPLY, nets, name, tok)          - rewrites the last value by `nets[name]'
+W_MEMO    = 4   # (W_MEMO, name, tok)                 - `memo_transform' of the last value (resolved already)
+W_BIND    = 5   # (W_BIND, name, token)               - binds the last value in the top frame
+W_CALL    = 6   # (W_CALL, name, f, tok)              - runs the body of `f'
+W_STMT    = 7   # (W_STMT, stmts, pc)                 - runs `stmts[pc:]'
+W_RETURN  = 8   # (W_RETURN, key, epoch, tok, name, t0) - `function_result'
+W_RESOLVE = 9   # (W_RESOLVE, comptime, tok[, cycles]) - re-evaluates the last value until it has no calls
+W_LET     = 10  # (W_LET, StmtLet)
+W_SHOW    = 11  # (W_SHOW, StmtShow)
+W_REPEAT  = 12  # (W_REPEAT, StmtRepeat)              - runs the body as many times as the last value says
+W_LOOP    = 13  # (W_LOOP, stmts, n)                  - runs `stmts' n more times
+W_FIX     = 14  # (W_FIX, StmtFix)                    - binds the last value, again until it doesn't change
+W_MEMOIZE = 15  # (W_MEMOIZE, key)                    - caches the last value by `key' (see `W_MEMO')
+
+def machine_call(work: List[Tuple[Any, ...]], e: ExprCall | SExprCall, f: Tuple[Token, List[str], List[Stmt], Context], args: Sequence[Expr] | Sequence[SExpr], op: int, comptime: bool, tok: Token | None) -> None:
+    """Pushes a function call. Like in `interpret_expr', the arguments are evaluated in the new frame."""
+    ip.ctx_list.append(f[3].clone())
+    l = len(f[1])
+    if len(args) != l:
+        raise RuntimeError(f"Expected {l} arguments but got {len(args)} arguments at {format_loc(tok) if tok else 'Somewhere'}")
+    work.append((W_CALL, e.fun, f, tok))
+    for i in range(l - 1, -1, -1):
+        work.append((W_BIND, f[1][i], args[i].token))
+        work.append((op, args[i], comptime, tok))
+
+def run_machine(work: List[Tuple[Any, ...]]) -> SExpr:
+    """The `stack' evaluator. Runs the work items, the result is the last value left."""
+    vals: List[SExpr] = []
+    while work:
+        w = work.pop()
+        op = w[0]
+        if op == W_SEXPR:
+            e, comptime, tok = w[1], w[2], w[3]
+            if not e.pending:
+                vals.append(e)
+            elif isinstance(e, SExprTuple):
+                work.append((W_TUPLE, len(e.el), None))
+                for i in reversed(e.el):
+                    work.append((W_SEXPR, i, False, None))
+            elif isinstance(e, SExprCall):
+                if comptime:
+                    vals.append(e)
+                    continue
+                kind, target = call_target(e.fun)
+                if kind == K_MEMO:
+                    work.append((W_MEMO, e.fun, tok))
+                    work.append((W_RESOLVE, False, tok))
+                    work.append((W_SEXPR, e.arg, False, tok))
+                elif kind == K_TRANSFORM:
+                    if ip.lazy:
+                        vals.append(lazy_force(e, tok))
+                    else:
+                        work.append((W_APPLY, ip.transformation_nets, e.fun, tok))
+                        work.append((W_SEXPR, e.arg, False, None))
+                else:
+                    f = get_function(e.fun) if kind == K_FUNCTION else None
+                    if f:
+                        if not isinstance(e.arg, SExprTuple):
+                            ip.ctx_list.append(f[3].clone())
+                            raise RuntimeError(f"SExpr kind {type(e.arg)} doesn't supported by functions at {format_loc(tok) if tok else 'Somewhere'}")
+                        machine_call(work, e, f, e.arg.el, W_SEXPR, comptime, tok)
+                    elif target is not None:
+                        vals.append(call_builtin(e, comptime, tok))
+                    else:
+                        raise RuntimeError(f"Unknown transformation or builtin function `{e.fun}' at {format_loc(tok) if tok else 'Somewhere'}")
+            else:
+                assert False, f"Unreachable: {e}"
+        elif op == W_EXPR:
+            x, comptime, tok = w[1], w[2], w[3]
+            if isinstance(x, ExprSymbol):
+                s = None if comptime else get_symbol(x.sym)
+                vals.append(s[0] if s else SExprSymbol(x.sym, x.token))
+            elif isinstance(x, ExprTuple):
+                work.append((W_TUPLE, len(x.el), x.token))
+                for j in reversed(x.el):
+                    work.append((W_EXPR, j, comptime, tok))
+            elif isinstance(x, ExprCall):
+                if comptime:
+                    vals.append(expr_to_sexpr(x))
+                    continue
+                kind, target = call_target(x.fun)
+                if kind == K_TRANSFORM and ip.lazy:
+                    vals.append(lazy_force(SExprCall(x.fun, expr_thunk(x.arg)), tok))
+                elif kind == K_MEMO or kind == K_TRANSFORM:
+                    if kind == K_MEMO:
+                        work.append((W_MEMO, x.fun, tok))
+                        work.append((W_RESOLVE, False, tok))
+                    else:
+                        work.append((W_APPLY, ip.transformation_nets, x.fun, tok))
+                    work.append((W_EXPR, x.arg, False, None))
+                else:
+                    f = get_function(x.fun) if kind == K_FUNCTION else None
+                    if f:
+                        if not isinstance(x.arg, ExprTuple):
+                            ip.ctx_list.append(f[3].clone())
+                            raise RuntimeError(f"Expr kind {type(x.arg)} doesn't supported by functions at {format_loc(tok) if tok else 'Somewhere'}")
+                        machine_call(work, x, f, x.arg.el, W_EXPR, comptime, tok)
+                    elif target is not None:
+                        vals.append(call_builtin(x, comptime, tok))
+                    else:
+                        raise RuntimeError(f"Unknown transformation or builtin function `{x.fun}' at {format_loc(tok) if tok else 'Somewhere'}")
+            elif isinstance(x, ExprCTCall):
+                if not comptime:
+                    raise RuntimeError(f"CT-Call is avaliable only at transformation definition at {format_loc(tok) if tok else 'Somewhere'}")
+                if x.fun in ip.meta_transformations:
+                    work.append((W_APPLY, ip.meta_transformation_nets, x.fun, tok))
+                    work.append((W_EXPR, x.arg, False, None))
+                elif x.fun in builtin_funcs:
+                    vals.append(call_builtin(x, comptime, tok))
+                else:
+                    raise RuntimeError(f"Unknown meta-transformation or builtin function `{x.fun}' at {format_loc(tok) if tok else 'Somewhere'}")
+            elif isinstance(x, ExprQuote):
+                vals.append(expr_to_sexpr(x.sentence))
+            else:
+                assert False, f"Unreachable: {x}"
+        elif op == W_TUPLE:
+            n = w[1]
+            el = vals[len(vals) - n:]
+            del vals[len(vals) - n:]
+            vals.append(SExprTuple(el, w[2]))
+        elif op == W_APPLY:
+            vals.append(substitute_compatible(vals.pop(), w[1][w[2]], w[3]))
+        elif op == W_MEMO:  # As `memo_transform', but the evaluation of a new result is pushed here
+            key = memo_key(w[1], vals.pop())
+            c = ip.memo_cache.get(key)
+            if c is not None:
+                vals.append(c)
+                continue
+            work.append((W_MEMOIZE, key))
+            work.append((W_RESOLVE, False, w[2]))
+            work.append((W_SEXPR, substitute_compatible(key[1], ip.transformation_nets[w[1]], w[2]), False, w[2]))
+        elif op == W_MEMOIZE:
+            ip.memo_cache.put(w[1], vals[-1])
+        elif op == W_BIND:
+            ip.ctx_list[-1].symbols[w[1]] = vals.pop(), w[2]
+        elif op == W_RESOLVE:
+            if is_unresolved(vals[-1]):
+                e = vals.pop()
+                comptime, tok = w[1], w[2]
+                if ip.lazy and not comptime and is_pure_sexpr(e, set()):
+                    vals.append(lazy_resolve(parallel_resolve(e, tok) if ip.parallel else e, tok))
+                    continue
+                if len(w) == 3:  # The first round, see `resolve_loop'
+                    w = (W_RESOLVE, comptime, tok, Cycles(e))
+                elif w[3] is not None and w[3].add(e):
+                    check_cycle(w[3], lambda x: run_machine([(W_SEXPR, x, comptime, tok)]), tok)
+                    w = (W_RESOLVE, comptime, tok, None)
+                work.append(w)
+                if ip.parallel and not comptime:
+                    e = parallel_resolve(e, tok)
+                work.append((W_SEXPR, e, comptime, tok))
+        elif op == W_CALL:
+            name, f, tok = w[1], w[2], w[3]
+            key, c = function_enter(name, f)
+            if c is not None:
+                vals.append(c)
+                continue
+            work.append((W_RETURN, key, ip.memo_epoch, tok, name, perf_counter_ns() if ip.profiler is not None else 0))
+            work.append((W_STMT, f[2], 0))
+        elif op == W_STMT:
+            stmts, pc = w[1], w[2]
+            if pc < len(stmts):
+                inst = stmts[pc]
+                work.append((W_STMT, stmts, pc + 1))
+                if isinstance(inst, StmtLet):
+                    work.append((W_LET, inst))
+                elif isinstance(inst, StmtShow):
+                    work.append((W_SHOW, inst))
+                elif isinstance(inst, StmtFix) and not is_pure_expr(inst.expr, set()):
+                    work.append((W_FIX, inst))
+                elif isinstance(inst, StmtRepeat) and pure_lets(inst.body) is None:
+                    work.append((W_REPEAT, inst))
+                    work.append((W_RESOLVE, False, inst.count.token))
+                    work.append((W_EXPR, inst.count, False, inst.count.token))
+                    continue
+                else:
+                    interpret_stmt(inst)
+                    continue
+                work.append((W_RESOLVE, False, inst.expr.token))
+                work.append((W_EXPR, inst.expr, False, inst.expr.token))
+        elif op == W_RETURN:
+            if ip.profiler is not None:
+                ip.profiler.call("func", w[4], perf_counter_ns() - w[5])
+            vals.append(function_result(w[4], w[1], w[2], w[3]))
+        elif op == W_LET:
+            interpreter_let(w[1].name, vals.pop(), w[1].token)
+        elif op == W_SHOW:
+            ip.out.show(vals.pop())
+        elif op == W_REPEAT:
+            work.append((W_LOOP, w[1].body, repeat_count(vals.pop(), w[1].token)))
+        elif op == W_LOOP:
+            if w[2] > 0:
+                work.append((W_LOOP, w[1], w[2] - 1))
+                work.append((W_STMT, w[1], 0))
+        elif op == W_FIX:
+            inst = w[1]
+            if fix_step(inst, vals.pop()):
+                work.append(w)
+                work.append((W_RESOLVE, False, inst.expr.token))
+                work.append((W_EXPR, inst.expr, False, inst.expr.token))
+        else:
+            assert False, f"Unknown work item {w}"
+    return vals[-1]
+
+def memo_transform(name: str, arg: SExpr, tok: Token | None) -> SExpr:
+    arg = interpret_sexpr_extra(arg, False, tok)
+    key = memo_key(name, arg)
+    r = ip.memo_cache.get(key)
+    if r is None:
+        r = interpret_sexpr_extra(substitute_compatible(arg, ip.transformation_nets[name], tok), False, tok)
+        ip.memo_cache.put(key, r)
+    return r
+
+def memo_key(name: str, arg: SExpr) -> Any:
+    """Only the results that can read a global symbol (through a function) are keyed by `memo_epoch'."""
+    if is_portable_call(name, set()):
+        return name, arg
+    return name, arg, ip.memo_epoch
+
+def memo_enabled(name: str) -> bool:
+    return ip.memo_pragmas.get(name, ip.memo_default) and is_pure_call(name, set())
+
+def is_pure_call(name: str, seen: Set[str]) -> bool:
+    """Whether calling `name' can't have side effects. Only the results for whole call graphs are cached."""
+    if name in seen:
+        return True
+    r = ip.purity.get(name)
+    if r is not None:
+        return r
+    top = not seen
+    seen.add(name)
+    if name in ip.transformations:
+        r = all(is_pure_sexpr(i[1], seen) for i in ip.transformations[name])
+    else:
+        f = get_function(name)
+        if f is not None:
+            r = is_pure_stmts(f[2], seen)
+        else:
+            r = name in builtin_funcs and name not in impure_builtins
+    if top:
+        ip.purity[name] = r
+    return r
+
+def is_pure_stmts(stmts: List[Stmt], seen: Set[str]) -> bool:
+    for p in stmts:
+        if isinstance(p, (StmtLet, StmtFix)):
+            if p.name in ip.ctx_glbl.symbols or not is_pure_expr(p.expr, seen):
+                return False
+        elif isinstance(p, StmtRepeat):
+            if not is_pure_expr(p.count, seen) or not is_pure_stmts(p.body, seen):
+                return False
+        else:
+            return False
+    return True
+
+def is_pure_sexpr(e: SExpr, seen: Set[str]) -> bool:
+    todo = [e]
+    while todo:
+        e = todo.pop()
+        if isinstance(e, SExprCall):
+            if not is_pure_call(e.fun, seen):
+                return False
+            todo.append(e.arg)
+        elif isinstance(e, SExprTuple):
+            todo.extend(e.el)
+    return True
+
+def is_pure_expr(e: Expr, seen: Set[str]) -> bool:
+    if isinstance(e, (ExprCall, ExprCTCall)):
+        return is_pure_call(e.fun, seen) and is_pure_expr(e.arg, seen)
+    if isinstance(e, ExprTuple):
+        return all(is_pure_expr(i, seen) for i in e.el)
+    return True
+
+# Lazy evaluation (`--lazy').
+# The argument of a transformation call isn't evaluated before the match. Its calls are thunks: they are
+# forced by `lazy_force' only when a rule needs to see a tuple or a constant symbol in their place
+# (the `demands' of `RuleNet.match'), and only to the head, so `form first: (A B) -> A' never evaluates `B'.
+# The head forms of the thunks are kept in `ip.thunks', so a shared thunk is evaluated once.
+# Only pure calls are thunks: the others (functions with side effects, `_LET') take an eager step
+# before the match, as without `--lazy', so the output is the same. A call pattern and a variable that
+# occurs twice in a pattern see their terms as without `--lazy' too (`lazy_demand').
+# Forcing runs on an explicit stack, and a pure value is resolved from the outside in by `lazy_resolve',
+# so a deep term (a long `(s (s ... sum[...]))') takes no Python stack in either evaluator.
+
+def expr_thunk(e: Expr) -> SExpr:
+    """Like `interpret_expr', but the transformation calls are left as they are."""
+    if isinstance(e, ExprSymbol):
+        s = get_symbol(e.sym)
+        return s[0] if s else SExprSymbol(e.sym, e.token)
+    if isinstance(e, ExprTuple):
+        return SExprTuple([expr_thunk(i) for i in e.el], e.token)
+    if isinstance(e, ExprCall) and e.fun in ip.transformations and not memo_enabled(e.fun):
+        return SExprCall(e.fun, expr_thunk(e.arg), e.token)
+    return interpret_expr(e, False, e.token)
+
+def lazy_force(e: SExprCall, tok: Token | None) -> SExpr:
+    """Evaluates a thunk to a head form: a symbol or a tuple, its elements can be thunks.
+    The thunks that a rewrite needs first are forced on an explicit stack, not by recursion."""
+    key = thunk_key(e)
+    r = ip.thunks.get(key)
+    if r is not None:
+        return r
+    # A frame: [key, the term, `Cycles', the net and the argument of the rewrite in progress, `stepped' of `lazy_demand']
+    stack: List[List[Any]] = [[key, e, Cycles(e), None, None, None]]
+    while True:
+        f = stack[-1]
+        if f[3] is None:
+            x = f[1]
+            if not isinstance(x, SExprCall):
+                stack.pop()
+                if is_pure_sexpr(f[0][0], set()):
+                    ip.thunks.put(f[0], x)
+                if not stack:
+                    return x
+                stack[-1][4] = replace_thunk(stack[-1][4], f[0][0], x)
+                continue
+            if x.fun not in ip.transformations or memo_enabled(x.fun):
+                lazy_next(f, interpret_sexpr(x, False, tok), tok)
+                continue
+            f[3] = ip.transformation_nets[x.fun]
+            f[4] = step_impure(x.arg, tok)
+            f[5] = set()
+        f[4], t = lazy_demand(f[3], f[4], f[5], tok)
+        if t is None:
+            res = substitute_compatible(f[4], f[3], tok)
+            f[3] = f[4] = f[5] = None
+            lazy_next(f, res, tok)
+            continue
+        key = thunk_key(t)
+        r = ip.thunks.get(key)
+        if r is not None:
+            f[4] = replace_thunk(f[4], t, r)
+        else:
+            stack.append([key, t, Cycles(t), None, None, None])
+
+def thunk_key(t: SExprCall) -> Tuple[Any, ...]:
+    """As `memo_key': only a thunk that can reach a function is evaluated again after a global write."""
+    return (t,) if is_portable_sexpr(t, set()) else (t, ip.memo_epoch)
+
+def lazy_next(f: List[Any], x: SExpr, tok: Token | None) -> None:
+    """Moves the frame `f' of `lazy_force' to the next term `x'."""
+    f[1] = x
+    if f[2] is not None and f[2].add(x):
+        check_cycle(f[2], lambda y: lazy_step(y, tok) if isinstance(y, SExprCall) else y, tok)
+        f[2] = None
+
+def lazy_step(x: SExprCall, tok: Token | None) -> SExpr:
+    if x.fun in ip.transformations and not memo_enabled(x.fun):
+        return lazy_apply(x.fun, x.arg, tok)
+    return interpret_sexpr(x, False, tok)
+
+def lazy_apply(name: str, arg: SExpr, tok: Token | None) -> SExpr:
+    """Rewrites `name[arg]' once, forcing the thunks of `arg' that the rules before the match look into."""
+    net = ip.transformation_nets[name]
+    arg = step_impure(arg, tok)
+    stepped: Set[SExpr] = set()
+    while True:
+        arg, t = lazy_demand(net, arg, stepped, tok)
+        if t is None:
+            return substitute_compatible(arg, net, tok)
+        arg = replace_thunk(arg, t, lazy_force(t, tok))
+
+def lazy_demand(net: RuleNet, arg: SExpr, stepped: Set[SExpr], tok: Token | None) -> Tuple[SExpr, SExprCall | None]:
+    """The next thunk of `arg' to force before `net' rewrites it, or None. The thunks that the rules match as calls
+    and the values of the variables that occur twice in a pattern are compared as they are without `--lazy',
+    so they're replaced here by `eager_step' (once, the results are kept in `stepped')."""
+    while arg.pending:
+        demands: List[Tuple[int, SExpr, bool]] = []
+        best = net.match(arg, None, demands)
+        need = [d for d in demands if (best == -1 or d[0] <= best) and not (d[2] and d[1] in stepped)]
+        if need:
+            d = min(need, key=lambda d: d[0])
+            if not d[2]:
+                assert isinstance(d[1], SExprCall)
+                return arg, d[1]
+            todo = [d[1]]
+        elif best != -1 and net.nonlinear[best]:
+            todo = [v for v in repeated_values(arg, net.forms[best][0]) if v.pending and v not in stepped]
+        else:
+            todo = []
+        if not todo:
+            break
+        for v in todo:
+            w = eager_step(v, tok)
+            stepped.add(w)
+            arg = replace_thunk(arg, v, w)
+    return arg, None
+
+def repeated_values(expr: SExpr, form: SExpr) -> List[SExpr]:
+    """The subterms of `expr' bound to the variables that occur more than once in `form'."""
+    m: Dict[str, List[SExpr]] = {}
+    todo = [(expr, form)]
+    while todo:
+        expr, form = todo.pop()
+        if isinstance(form, SExprSymbol) and form.var:
+            m.setdefault(form.sym, []).append(expr)
+        elif isinstance(form, SExprTuple) and isinstance(expr, SExprTuple):
+            todo.extend(zip(expr.el, form.el))
+    return [v for vs in m.values() if len(vs) > 1 for v in vs]
+
+def eager_step(e: SExpr, tok: Token | None) -> SExpr:
+    """`e' as the argument of a call has it without `--lazy': its calls are evaluated once by `interpret_sexpr'."""
+    ip.lazy = False
+    try:
+        return interpret_sexpr(e, False, tok)
+    finally:
+        ip.lazy = True
+
+def lazy_resolve(e: SExpr, tok: Token | None) -> SExpr:
+    """Forces all the thunks of a pure term, from the outside in, on an explicit stack. The result has no calls.
+    The memoized calls are evaluated here as by `memo_transform', without recursion."""
+    vals: List[SExpr] = []
+    # ('T', n) packs a tuple, ('M', name) calls `name' on the last value, ('P', key) caches it.
+    todo: List[Any] = [e]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, tuple):
+            if x[0] == 'T':
+                el = vals[len(vals) - x[1]:]
+                del vals[len(vals) - x[1]:]
+                vals.append(SExprTuple(el))
+            elif x[0] == 'M':
+                key = memo_key(x[1], vals.pop())
+                r = ip.memo_cache.get(key)
+                if r is not None:
+                    vals.append(r)
+                else:
+                    todo.append(('P', key))
+                    todo.append(substitute_compatible(key[1], ip.transformation_nets[x[1]], tok))
+            else:
+                ip.memo_cache.put(x[1], vals[-1])
+        elif not x.pending:
+            vals.append(x)
+        elif isinstance(x, SExprCall):
+            if call_target(x.fun)[0] == K_MEMO:
+                todo.append(('M', x.fun))
+                todo.append(x.arg)
+            else:
+                todo.append(lazy_force(x, tok))
+        else:
+            todo.append(('T', len(x.el)))
+            todo.extend(reversed(x.el))
+    return vals[0]
+
+def step_impure(e: SExpr, tok: Token | None) -> SExpr:
+    """Takes an eager step on the calls in the tuple spine of `e' that can't be thunks."""
+    vals: List[SExpr] = []
+    todo: List[Any] = [e]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, int):
+            el = vals[len(vals) - x:]
+            del vals[len(vals) - x:]
+            vals.append(SExprTuple(el))
+        elif not x.pending:
+            vals.append(x)
+        elif isinstance(x, SExprCall):
+            vals.append(x if is_pure_sexpr(x, set()) else interpret_sexpr(x, False, tok))
+        else:
+            todo.append(len(x.el))
+            todo.extend(reversed(x.el))
+    return vals[0]
+
+def replace_thunk(e: SExpr, t: SExpr, v: SExpr) -> SExpr:
+    """Replaces every `t' in `e' by `v', `v' itself isn't looked into."""
+    vals: List[SExpr] = []
+    todo: List[Any] = [e]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, tuple):  # ('C', fun) or ('T', n), as in `instantiate'
+            if x[0] == 'C':
+                vals.append(SExprCall(x[1], vals.pop()))
+            else:
+                el = vals[len(vals) - x[1]:]
+                del vals[len(vals) - x[1]:]
+                vals.append(SExprTuple(el))
+        elif x is t:
+            vals.append(v)
+        elif not x.pending:
+            vals.append(x)
+        elif isinstance(x, SExprCall):
+            todo.append(('C', x.fun))
+            todo.append(x.arg)
+        else:
+            todo.append(('T', len(x.el)))
+            todo.extend(reversed(x.el))
+    return vals[0]
+
+# Parallel evaluation (`--parallel').
+# When a value is resolved (`interpret_sexpr_extra' and friends) and it's a tuple, its elements don't
+# depend on each other. The calls in its tuple spine that are big enough (`parallel_min') and portable
+# (only transformations and pure builtins, no functions, `_LET' or output) are resolved at once on a pool
+# of `ip.parallel' processes, the smaller ones are left to the usual steps. This gives the same result:
+# every element of a tuple steps on its own until it has no calls.
+# The workers get the transformations when the pool is started, it's restarted after they change.
+# The terms are sent by `encode_term'. The profiler and the tracer see only this process, so they turn it off.
+
+def is_portable_call(name: str, seen: Set[str]) -> bool:
+    if name in seen:
+        return True
+    r = ip.portable.get(name)
+    if r is not None:
+        return r
+    top = not seen
+    seen.add(name)
+    if name in ip.transformations:
+        r = all(is_portable_sexpr(i[1], seen) for i in ip.transformations[name])
+    else:
+        r = name not in ip.function_names and name in builtin_funcs and name not in impure_builtins
+    if top:
+        ip.portable[name] = r
+    return r
+
+def is_portable_sexpr(e: SExpr, seen: Set[str]) -> bool:
+    todo = [e]
+    while todo:
+        e = todo.pop()
+        if isinstance(e, SExprCall):
+            if not is_portable_call(e.fun, seen):
+                return False
+            todo.append(e.arg)
+        elif isinstance(e, SExprTuple) and e.pending:
+            todo.extend(e.el)
+    return True
+
+def parallel_init(forms: Dict[str, List[Tuple[SExpr, SExpr, Token]]], opts: Dict[str, Any]) -> None:
+    it = Interpreter()
+    for k, v in opts.items():
+        setattr(it, k, v)
+    for name, rules in forms.items():
+        it.transformations[name] = rules
+        it.transformation_nets[name] = RuleNet(name=name)
+        for s, r, tok in rules:
+            it.transformation_nets[name].add(s, r, tok)
+    it.activate()
+
+def parallel_task(data: Tuple[List[str], bytes]) -> Tuple[str | None, Tuple[List[str], bytes] | None]:
+    """Resolves a term in a worker. Returns the error message or the result."""
+    try:
+        return None, encode_term(interpret_sexpr_extra(decode_term(data)))
+    except Exception as e:
+        return str(e), None
+
+def parallel_pool() -> Any:
+    if ip.pool is None or ip.pool_version != ip.forms_version:
+        ip.close()
+        opts = {"rule_engine": ip.rule_engine, "evaluator": ip.evaluator, "memo_default": ip.memo_default, "memo_pragmas": ip.memo_pragmas}
+        ip.pool = multiprocessing.Pool(ip.parallel, parallel_init, (ip.transformations, opts))
+        ip.pool_version = ip.forms_version
+    return ip.pool
+
+def parallel_resolve(e: SExpr, tok: Token | None) -> SExpr:
+    """Resolves the big portable calls in the tuple spine of `e' on the pool."""
+    if not isinstance(e, SExprTuple) or ip.profiler is not None or ip.tracer is not None:
+        return e
+    jobs: Dict[SExpr, SExpr | None] = {}
+    todo: List[SExpr] = [e]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, SExprCall):
+            if x.size >= ip.parallel_min and is_portable_call(x.fun, set()) and is_portable_sexpr(x.arg, set()):
+                jobs[x] = None
+        elif isinstance(x, SExprTuple) and x.pending:
+            todo.extend(reversed(x.el))
+    if len(jobs) < 2:
+        return e
+    for j, (err, r) in zip(list(jobs), parallel_pool().map(parallel_task, [encode_term(j) for j in jobs], 1)):
+        if err is not None:
+            raise RuntimeError(err)
+        assert r is not None
+        jobs[j] = decode_term(r)
+    # The spine is rebuilt bottom-up with the results in place of the calls.
+    vals: List[SExpr] = []
+    todo2: List[Any] = [e]
+    while todo2:
+        x = todo2.pop()
+        if isinstance(x, int):
+            el = vals[len(vals) - x:]
+            del vals[len(vals) - x:]
+            vals.append(SExprTuple(el))
+        elif isinstance(x, SExprTuple) and x.pending:
+            todo2.append(len(x.el))
+            todo2.extend(reversed(x.el))
+        else:
+            r = jobs.get(x)
+            vals.append(x if r is None else r)
+    return vals[0]
+
+
+def call_builtin(e: ExprCall | SExprCall | ExprCTCall, comptime: bool, tok: Token | None) -> SExpr:
+    if ip.profiler is None:
+        return builtin_funcs[e.fun](BuiltinFunc_Args(e, comptime, tok))
+    t0 = perf_counter_ns()
+    try:
+        return builtin_funcs[e.fun](BuiltinFunc_Args(e, comptime, tok))
+    finally:
+        ip.profiler.call("builtin", e.fun, perf_counter_ns() - t0)
+
+# Profiling (`--profile').
+# `substitute_compatible', the function calls and `call_builtin' report to `profiler' when it's set.
+# Rules are told apart by the location of their `form'. The times of calls are inclusive.
+
+class RuleStats:
+    __slots__ = ("attempts", "matches", "t_walk", "t_build", "out_nodes", "out_max")
+
+    def __init__(self) -> None:
+        self.attempts = 0  # How many times the rule was checked at a leaf of the `RuleNet'.
+        self.matches = 0
+        self.t_walk = 0
+        self.t_build = 0
+        self.out_nodes = 0
+        self.out_max = 0
+
+class CallStats:
+    __slots__ = ("calls", "fails", "time")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.fails = 0
+        self.time = 0  # For transformations it's the time of `RuleNet.match'.
+
+class Profiler:
+    transforms: Dict[str, CallStats]
+    rules: Dict[Tuple[str, str], RuleStats]
+    calls: Dict[Tuple[str, str], CallStats]
+
+    def __init__(self) -> None:
+        self.transforms = {}
+        self.rules = {}
+        self.calls = {}
+
+    def call(self, kind: str, name: str, t: int) -> None:
+        c = self.calls.get((kind, name))
+        if c is None:
+            c = self.calls[(kind, name)] = CallStats()
+        c.calls += 1
+        c.time += t
+
+    def rule(self, net: RuleNet, i: int) -> RuleStats:
+        tok = net.locs[i]
+        key = (net.name, format_loc(tok, LocFmtStyle.Editor) if tok else f"#{i}")
+        r = self.rules.get(key)
+        if r is None:
+            r = self.rules[key] = RuleStats()
+        return r
+
+    def rows(self) -> List[Dict[str, Any]]:
+        rows: List[Dict[str, Any]] = []
+        rule_time: Dict[str, int] = {}
+        for (name, loc), r in self.rules.items():
+            t = r.t_walk + r.t_build
+            rule_time[name] = rule_time.get(name, 0) + t
+            rows.append({"kind": "rule", "name": name, "loc": loc, "calls": r.attempts, "hits": r.matches,
+                         "time_ns": t, "walk_ns": r.t_walk, "build_ns": r.t_build,
+                         "out_nodes": r.out_nodes, "out_max": r.out_max})
+        for name, c in self.transforms.items():
+            rows.append({"kind": "form", "name": name, "loc": "", "calls": c.calls, "hits": c.calls - c.fails,
+                         "time_ns": c.time + rule_time.get(name, 0), "match_ns": c.time})
+        for (kind, name), c in self.calls.items():
+            rows.append({"kind": kind, "name": name, "loc": "", "calls": c.calls, "hits": c.calls, "time_ns": c.time})
+        rows.sort(key=lambda r: (-r["time_ns"], r["kind"], r["name"], r["loc"]))
+        return rows
+
+    def report(self, f: TextIO) -> None:
+        print(f"{'kind':<8} {'name':<16} {'rule':<24} {'calls':>9} {'hits':>9} {'time ms':>10} {'avg out':>8} {'max out':>8}", file=f)
+        for r in self.rows():
+            avg = f"{r['out_nodes'] / r['hits']:.1f}" if r["kind"] == "rule" and r["hits"] else ""
+            mx = str(r["out_max"]) if r["kind"] == "rule" else ""
+            print(f"{r['kind']:<8} {r['name']:<16} {r['loc']:<24} {r['calls']:>9} {r['hits']:>9} {r['time_ns'] / 1e6:>10.3f} {avg:>8} {mx:>8}", file=f)
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.rows(), f, indent=1)
+
+def profiled_substitute(expr: SExpr, net: RuleNet, tok: Token | None) -> SExpr:
+    """`substitute_compatible' that reports to `profiler'."""
+    assert ip.profiler is not None
+    c = ip.profiler.transforms.get(net.name)
+    if c is None:
+        c = ip.profiler.transforms[net.name] = CallStats()
+    tried: List[int] = []
+    t0 = perf_counter_ns()
+    i = net.match(expr, tried)
+    t1 = perf_counter_ns()
+    c.calls += 1
+    c.time += t1 - t0
+    for j in tried:
+        ip.profiler.rule(net, j).attempts += 1
+    if i == -1:
+        c.fails += 1
+        raise no_rule_error(expr, net, tok)
+    r = ip.profiler.rule(net, i)
+    if ip.rule_engine == "generic":
+        s, f = net.forms[i]
+        m = walk(expr, s, {}, tok)
+        t2 = perf_counter_ns()
+        res = instantiate(f, m)
+        r.t_walk += t2 - t1
+        r.t_build += perf_counter_ns() - t2
+    else:
+        res = apply_rule(expr, net, i, tok)
+        r.t_build += perf_counter_ns() - t1
+    r.matches += 1
+    r.out_nodes += res.size
+    if res.size > r.out_max:
+        r.out_max = res.size
+    if ip.tracer is not None:
+        ip.tracer.emit(TraceEvent("rule", net.name, i, expr, res))
+    return res
+
+# Tracing.
+# `subscribe' registers a function that gets the interpreter events in batches, in the order they happened:
+#   rule   - `name' rewrote `input' to `output' by its rule number `index' (meta-transformations end with "`"),
+#   enter  - the function `name' is called, `input' is the tuple of its arguments,
+#   exit   - the function `name' returned `output',
+#   bind   - `output' is bound to the symbol `name' by `let' or `_LET',
+#   unlink - `name' is unlinked, `output' is `form', `symbol' or `func',
+#   cycle  - the symbols `name' (separated by spaces) of a `repeat' come back to `input' every `index' steps,
+#            `output' is the step that first reaches it.
+# The events are kept in a ring buffer that is passed to the subscribers when it's full and on `flush_events'.
+# While there are no subscribers `tracer' is None and the hooks cost one check.
+
+@dataclass
+class TraceEvent:
+    kind: str
+    name: str
+    index: int = -1
+    input: SExpr | None = None
+    output: SExpr | None = None
+
+class Tracer:
+    subscribers: List[Callable[[List[TraceEvent]], None]]
+    buf: List[TraceEvent | None]
+    n: int
+
+    def __init__(self, size: int) -> None:
+        self.subscribers = []
+        self.buf = [None] * size
+        self.n = 0
+
+    def emit(self, ev: TraceEvent) -> None:
+        self.buf[self.n] = ev
+        self.n += 1
+        if self.n == len(self.buf):
+            self.flush()
+
+    def flush(self) -> None:
+        if self.n:
+            batch = cast(List[TraceEvent], self.buf[:self.n])
+            self.n = 0
+            for s in self.subscribers:
+                s(batch)
+
+def subscribe(fn: Callable[[List[TraceEvent]], None], batch: int = 256) -> None:
+    """Registers `fn'. A step debugger wants `batch=1', so that it gets every event at once.
+    The buffer is shared, with several subscribers the smallest `batch' is used."""
+    if ip.tracer is None:
+        ip.tracer = Tracer(batch)
+    elif batch < len(ip.tracer.buf):
+        ip.tracer.flush()
+        ip.tracer.buf = [None] * batch
+    ip.tracer.subscribers.append(fn)
+
+def unsubscribe(fn: Callable[[List[TraceEvent]], None]) -> None:
+    if ip.tracer is None or fn not in ip.tracer.subscribers:
+        return
+    ip.tracer.flush()
+    ip.tracer.subscribers.remove(fn)
+    if not ip.tracer.subscribers:
+        ip.tracer = None
+
+def flush_events() -> None:
+    if ip.tracer is not None:
+        ip.tracer.flush()
+
+class TraceWriter:
+    """A subscriber that writes the events as JSON lines (`--trace')."""
+    f: TextIO
+
+    def __init__(self, f: TextIO) -> None:
+        self.f = f
+
+    def __call__(self, batch: List[TraceEvent]) -> None:
+        for ev in batch:
+            d: Dict[str, Any] = {"event": ev.kind, "name": ev.name}
+            if ev.index != -1:
+                d["index"] = ev.index
+            if ev.input is not None:
+                d["input"] = stringify(ev.input)
+            if ev.output is not None:
+                d["output"] = stringify(ev.output)
+            self.f.write(json.dumps(d) + "\n")
 
 @dataclass
 class BuiltinFunc_Args:
@@ -171,98 +1452,145 @@ class BuiltinFunc_Args:
 # TBD: resolve function calls in bf_* statements.
 
 def bf_iscomptime(args: BuiltinFunc_Args) -> SExpr:
-    return SExprSymbol(args.e.token, False, "TRUE" if args.is_at_comptime else "FALSE")
+    return SExprSymbol("TRUE" if args.is_at_comptime else "FALSE", args.e.token)
 
 def bf_length(args: BuiltinFunc_Args) -> SExpr:
     if isinstance(args.e.arg, ExprSymbol):
-        return SExprSymbol(args.e.token, False, str(len(args.e.arg.sym)))
+        return SExprSymbol(str(len(args.e.arg.sym)), args.e.token)
     elif isinstance(args.e.arg, ExprTuple):
-        return SExprSymbol(args.e.token, False, str(len(args.e.arg.el)))
+        return SExprSymbol(str(len(args.e.arg.el)), args.e.token)
     else:
-        raise RuntimeError(f"Expected ExprSymbol/ExprTuple but got `{type(args.e.arg)}' at {format_loc(args.e.arg.token) if isinstance(args.e.arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected ExprSymbol/ExprTuple but got `{type(args.e.arg)}' at {format_loc(args.e.arg.token) if isinstance(args.e.arg, (Expr, SExpr)) else 'Somewhere'}")
 
 def bf_is_symbol(args: BuiltinFunc_Args) -> SExpr:
     if isinstance(args.e.arg, ExprSymbol):
-        return SExprSymbol(args.e.token, False, "TRUE")
-    return SExprSymbol(args.e.token, False, "FALSE")
+        return SExprSymbol("TRUE", args.e.token)
+    return SExprSymbol("FALSE", args.e.token)
 
 def bf_gi(args: BuiltinFunc_Args) -> SExpr:
     arg = interpret_sexpr(args.e.arg, args.is_at_comptime, args.token) if isinstance(args.e.arg, SExpr) else interpret_expr(args.e.arg, args.is_at_comptime, args.token)
     if not isinstance(arg, SExprTuple) or len(arg.el) != 2:
-        raise RuntimeError(f"Expected ({{EL}} {{ID}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected ({{EL}} {{ID}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if not isinstance(arg.el[0], SExprTuple):
-        raise RuntimeError(f"Expected tuple but got `{stringify(arg.el[0])}' at {format_loc(arg.el[0].token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected tuple but got `{stringify(arg.el[0])}' at {format_loc(arg.el[0].token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if not isinstance(arg.el[1], SExprSymbol):
-        raise RuntimeError(f"Expected symbol but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected symbol but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if not arg.el[1].sym.isnumeric():
-        raise RuntimeError(f"Expected numberic but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected numberic but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, SExpr) else 'Somewhere'}")
     return arg.el[0].el[int(arg.el[1].sym)]
 
 def bf_si(args: BuiltinFunc_Args) -> SExpr:
     arg = interpret_sexpr(args.e.arg, args.is_at_comptime, args.token) if isinstance(args.e.arg, SExpr) else interpret_expr(args.e.arg, args.is_at_comptime, args.token)
     if not isinstance(arg, SExprTuple) or len(arg.el) != 3:
-        raise RuntimeError(f"Expected ({{EL}} {{ID}} {{VL}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected ({{EL}} {{ID}} {{VL}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if not isinstance(arg.el[0], SExprTuple):
-        raise RuntimeError(f"Expected tuple but got `{stringify(arg.el[0])}' at {format_loc(arg.el[0].token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected tuple but got `{stringify(arg.el[0])}' at {format_loc(arg.el[0].token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if not isinstance(arg.el[1], SExprSymbol):
-        raise RuntimeError(f"Expected symbol but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected symbol but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if not arg.el[1].sym.isnumeric():
-        raise RuntimeError(f"Expected numberic but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected numberic but got `{stringify(arg.el[1])}' at {format_loc(arg.el[1].token) if isinstance(arg, SExpr) else 'Somewhere'}")
     i = int(arg.el[1].sym)
-    return SExprTuple(arg.token, False, arg.el[0].el[:i]+[arg.el[2]]+arg.el[0].el[i+1:])
+    return tuple_set(arg.el[0], i, arg.el[2])
 
 def bf_concat(args: BuiltinFunc_Args) -> SExpr:
     arg = interpret_sexpr(args.e.arg, args.is_at_comptime, args.token) if isinstance(args.e.arg, SExpr) else interpret_expr(args.e.arg, args.is_at_comptime, args.token)
     if not isinstance(arg, SExprTuple) or len(arg.el) != 2:
-        raise RuntimeError(f"Expected ({{STR}} {{STR}}) or ({{TUPLE}} {{TUPLE}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected ({{STR}} {{STR}}) or ({{TUPLE}} {{TUPLE}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if isinstance(arg.el[0], SExprTuple) and \
        isinstance(arg.el[1], SExprTuple):
-        return SExprTuple(arg.token, False, arg.el[0].el+arg.el[1].el)
+        return tuple_concat(arg.el[0], arg.el[1])
     if isinstance(arg.el[0], SExprSymbol) and \
        isinstance(arg.el[1], SExprSymbol):
-        return SExprSymbol(arg.token, False, arg.el[0].sym+arg.el[1].sym)
-    raise RuntimeError(f"Expected ({{STR}} {{STR}}) or ({{TUPLE}} {{TUPLE}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, Expr) else 'Somewhere'}")
+        return symbol_concat(arg.el[0], arg.el[1])
+    raise RuntimeError(f"Expected ({{STR}} {{STR}}) or ({{TUPLE}} {{TUPLE}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, SExpr) else 'Somewhere'}")
 
 def bf_to_peano(args: BuiltinFunc_Args) -> SExpr:
-    tok = args.token if args.token is not None else NITOK
     arg = interpret_sexpr(args.e.arg, args.is_at_comptime, args.token) if isinstance(args.e.arg, SExpr) else interpret_expr(args.e.arg, args.is_at_comptime, args.token)
     if not isinstance(arg, SExprSymbol) or not arg.sym.isnumeric():
-        raise RuntimeError(f"Expected numberic but got `{stringify(arg)}' at {format_loc(args.e.arg.token) if isinstance(arg, Expr) else 'Somewhere'}")
-    a = SExprTuple(tok, False, [])
-    b = a
-    i = 0
+        raise RuntimeError(f"Expected numberic but got `{stringify(arg)}' at {format_loc(args.e.arg.token) if isinstance(arg, SExpr) else 'Somewhere'}")
     c = int(arg.sym)
-    while i < c:
-        b.el.append(SExprSymbol(tok, False, "s"))
-        b.el.append(SExprTuple(tok, False, []) if i != c - 1 else SExprSymbol(tok, False, "0"))
-        if isinstance(b.el[1], SExprTuple):
-            b = b.el[1]
-        i += 1
-    return a
+    if c == 0:
+        return SExprTuple(())
+    return SExprPeano(c)
+
+# Arithmetic on decimal symbols (`12', `-3'), the numbers are Python ints of any size.
+# Unlike the builtins above, the argument is resolved completely: `_ADD[(fib[N] 1)]' adds the value of `fib[N]'.
+# At comptime only the CT-calls in it are evaluated.
+
+def bf_resolved_arg(args: BuiltinFunc_Args) -> SExpr:
+    if isinstance(args.e.arg, SExpr):
+        return interpret_sexpr(args.e.arg, True, args.token) if args.is_at_comptime else interpret_sexpr_extra(args.e.arg, False, args.token)
+    return interpret_expr(args.e.arg, True, args.token) if args.is_at_comptime else interpret_expr_extra(args.e.arg, False, args.token)
+
+def bf_decimal(e: SExpr, token: Token | None) -> int:
+    if not isinstance(e, SExprSymbol) or not (e.sym[1:] if e.sym[:1] == "-" else e.sym).isdecimal():
+        raise RuntimeError(f"Expected decimal but got `{stringify(e)}' at {format_loc(token) if token else 'Somewhere'}")
+    return int(e.sym)
+
+def bf_operands(args: BuiltinFunc_Args, what: str, n: int = 2) -> List[int]:
+    """The numbers of a tuple of `n' decimals, any number of them (at least one) if `n' is 0."""
+    arg = bf_resolved_arg(args)
+    if not isinstance(arg, SExprTuple) or (len(arg.el) != n if n else not arg.el):
+        raise RuntimeError(f"Expected {what} but got `{stringify(arg)}' at {format_loc(args.token) if args.token else 'Somewhere'}")
+    return [bf_decimal(i, args.token) for i in arg.el]
+
+def bf_add(args: BuiltinFunc_Args) -> SExpr:
+    return SExprSymbol(str(sum(bf_operands(args, "({NUM} ...)", 0))))
+
+def bf_sub(args: BuiltinFunc_Args) -> SExpr:
+    a, b = bf_operands(args, "({NUM} {NUM})")
+    return SExprSymbol(str(a - b))
+
+def bf_mul(args: BuiltinFunc_Args) -> SExpr:
+    r = 1
+    for i in bf_operands(args, "({NUM} ...)", 0):
+        r *= i
+    return SExprSymbol(str(r))
+
+def bf_divmod(args: BuiltinFunc_Args) -> SExpr:
+    a, b = bf_operands(args, "({NUM} {NUM})")
+    if b == 0:
+        raise RuntimeError(f"Division by zero at {format_loc(args.token) if args.token else 'Somewhere'}")
+    q, r = divmod(a, b)
+    return SExprTuple((SExprSymbol(str(q)), SExprSymbol(str(r))))
+
+def bf_cmp(args: BuiltinFunc_Args) -> SExpr:
+    a, b = bf_operands(args, "({NUM} {NUM})")
+    return SExprSymbol("LT" if a < b else "GT" if a > b else "EQ")
+
+def bf_from_peano(args: BuiltinFunc_Args) -> SExpr:
+    arg = bf_resolved_arg(args)
+    if isinstance(arg, SExprPeano):
+        return SExprSymbol(str(arg.n))
+    if arg is PEANO_ZERO or arg == SExprTuple(()):  # `_TOPEANO[0]' gives `()'.
+        return SExprSymbol("0")
+    raise RuntimeError(f"Expected Peano number but got `{stringify(arg)}' at {format_loc(args.token) if args.token else 'Somewhere'}")
 
 def bf_inclusion_level(args: BuiltinFunc_Args) -> SExpr:
-    tok = args.token if args.token is not None else NITOK
     arg = interpret_sexpr(args.e.arg, args.is_at_comptime, args.token) if isinstance(args.e.arg, SExpr) else interpret_expr(args.e.arg, args.is_at_comptime, args.token)
     if not isinstance(arg, SExprTuple):
-        raise RuntimeError(f"Expected tuple but got `{stringify(arg)}' at {format_loc(args.e.arg.token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected tuple but got `{stringify(arg)}' at {format_loc(args.e.arg.token) if isinstance(arg, SExpr) else 'Somewhere'}")
     a = 1
     r = True
     while r:
         r = False
+        if isinstance(arg, SExprPeano):  # Only the last element of a numeral is a tuple.
+            a += arg.n - 1
+            break
         for i in arg.el:
             if isinstance(i, SExprTuple):
                 r = True
                 arg = i
                 a += 1
                 break
-    return SExprSymbol(tok, False, str(a))
+    return SExprSymbol(str(a), args.token)
 
 def bf_let(args: BuiltinFunc_Args) -> SExpr:
     arg = interpret_sexpr(args.e.arg, args.is_at_comptime, args.token) if isinstance(args.e.arg, SExpr) else interpret_expr(args.e.arg, args.is_at_comptime, args.token)
     if not isinstance(arg, SExprTuple) or len(arg.el) != 2:
-        raise RuntimeError(f"Expected ({{ID}} {{EL}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected ({{ID}} {{EL}}) but got `{stringify(arg)}' at {format_loc(arg.token) if isinstance(arg, SExpr) else 'Somewhere'}")
     if not isinstance(arg.el[0], SExprSymbol):
-        raise RuntimeError(f"Expected symbol but got `{stringify(arg.el[0])}' at {format_loc(arg.el[0].token) if isinstance(arg, Expr) else 'Somewhere'}")
+        raise RuntimeError(f"Expected symbol but got `{stringify(arg.el[0])}' at {format_loc(arg.el[0].token) if isinstance(arg, SExpr) else 'Somewhere'}")
     interpreter_let(arg.el[0].sym, arg.el[1], args.token)
     return arg.el[1]
 
@@ -274,43 +1602,216 @@ builtin_funcs: Dict[str, Callable[[BuiltinFunc_Args], SExpr]] = {
     "_CONCAT": bf_concat,
     "_GI": bf_gi,
     "_SI": bf_si,
+    "_ADD": bf_add,
+    "_SUB": bf_sub,
+    "_MUL": bf_mul,
+    "_DIVMOD": bf_divmod,
+    "_CMP": bf_cmp,
+    "_FROMPEANO": bf_from_peano,
     "_TOPEANO": bf_to_peano,
     "_INCLVL": bf_inclusion_level,
     "_LET": bf_let
 }
 
+impure_builtins = {"_LET"}
+
 def expr_to_sexpr(e: Expr) -> SExpr:
     if isinstance(e, ExprSymbol):
-        return SExprSymbol(e.token, False, e.sym)
+        return SExprSymbol(e.sym, e.token)
     if isinstance(e, ExprCall):
-        return SExprCall(e.token, False, e.fun, expr_to_sexpr(e.arg))
+        return SExprCall(e.fun, expr_to_sexpr(e.arg), e.token)
     if isinstance(e, ExprTuple):
-        return SExprTuple(e.token, False, [expr_to_sexpr(i) for i in e.el])
+        return SExprTuple([expr_to_sexpr(i) for i in e.el], e.token)
     assert False, f"Unreachable: {e}"
 
 def interpreter_let(name: str, expr: SExpr, tok: Token | None) -> None:
-    if name in transformations:
+    if name in ip.transformations:
         raise RuntimeError(f"Failed to define symbol `{name}' at {format_loc(tok) if tok else 'Somewhere'}\nThis name is already taken by a transformation'")
     set_symbol(name, (expr, tok))
+    if ip.tracer is not None:
+        ip.tracer.emit(TraceEvent("bind", name, -1, None, expr))
+
+# Loops: `repeat N { ... }' runs its body N times (a decimal number or a Peano numeral), `fix X = E'
+# binds X to E again and again until the value doesn't change. Terms are hash-consed, so the check is
+# an identity test. Both are loops in the evaluators, so they take no stack per iteration.
+#
+# Cycles. A term is its own fingerprint: equal terms are one object. `Cycles' finds the period of a
+# sequence of terms with Brent's algorithm in O(1) memory, the next term is compared with a mark that
+# is moved forward after 1, 2, 4, ... steps. When the steps are pure, the sequence is periodic from then on:
+#   - the evaluation of a pure term that comes back is an endless loop, it's an error,
+#   - `fix' over a pure expression that comes back to an old value never stops, it's an error too,
+#   - `repeat' over `let's of pure expressions skips the whole periods that are left, so reaching
+#     the step N of a periodic orbit takes O(period) steps after the cycle is found, not O(N).
+# The entry of a cycle is found by running the steps again from the start (`cycle_entry').
+# A function that writes a global isn't pure (`is_pure_stmts'), and the first steps may make the global,
+# so the purity is checked again when a cycle is found: impure steps are never skipped nor run again.
+
+class Cycles:
+    __slots__ = ("first", "mark", "power", "length")
+    first: SExpr
+    mark: SExpr
+    power: int
+    length: int
+
+    def __init__(self, first: SExpr) -> None:
+        self.first = first
+        self.mark = first
+        self.power = 1
+        self.length = 0
+
+    def add(self, e: SExpr) -> bool:
+        """Adds the next term. Returns whether it's the mark again, `length' is the period then."""
+        self.length += 1
+        if e is self.mark:
+            return True
+        if self.length == self.power:
+            self.mark = e
+            self.power *= 2
+            self.length = 0
+        return False
+
+def cycle_entry(first: SExpr, period: int, step: Callable[[SExpr], SExpr]) -> Tuple[int, SExpr]:
+    """The number of steps from `first' to the cycle and the term there. The steps run with the tracer and the profiler off."""
+    tracer, profiler = ip.tracer, ip.profiler
+    ip.tracer = ip.profiler = None
+    try:
+        a = b = first
+        for _ in range(period):
+            b = step(b)
+        mu = 0
+        while a is not b:
+            a, b = step(a), step(b)
+            mu += 1
+        return mu, a
+    finally:
+        ip.tracer, ip.profiler = tracer, profiler
+
+def check_cycle(c: Cycles, step: Callable[[SExpr], SExpr], tok: Token | None) -> None:
+    """Called when the evaluation of `c.first' comes back to a term. It never ends if the terms are pure."""
+    if is_pure_sexpr(c.first, set()):
+        mu, x = cycle_entry(c.first, c.length, step)
+        raise RuntimeError(f"The evaluation of `{stringify(c.first)}' never ends: after {mu} steps it comes back to `{stringify(x)}' every {c.length} steps at {format_loc(tok) if tok else 'Somewhere'}")
+
+def pure_lets(body: List[Stmt]) -> List[str] | None:
+    """The names bound by `body' if it has only `let's of pure expressions, its result depends only on their values."""
+    names: List[str] = []
+    for p in body:
+        if not isinstance(p, StmtLet) or not is_pure_expr(p.expr, set()):
+            return None
+        if p.name not in names:
+            names.append(p.name)
+    return names
+
+def loop_state(names: List[str]) -> SExpr:
+    if len(names) == 1:
+        return get_symbol(names[0])[0]  # type: ignore[index]
+    return SExprTuple(get_symbol(i)[0] for i in names)  # type: ignore[index]
+
+def loop_step(names: List[str], lets: List[Tuple[str, Expr]], state: SExpr) -> SExpr:
+    """Runs the `let's from the state `state' of `names', for `cycle_entry'."""
+    for i, v in zip(names, (state,) if len(names) == 1 else state.el):  # type: ignore[attr-defined]
+        set_symbol(i, (v, None))
+    for name, e in lets:
+        set_symbol(name, (interpret_expr_extra(e, False, e.token), None))
+    return loop_state(names)
+
+def loop_entry(names: List[str], lets: List[Tuple[str, Expr]], c: Cycles) -> Tuple[int, SExpr]:
+    saved = [get_symbol(i) for i in names]
+    try:
+        return cycle_entry(c.first, c.length, lambda x: loop_step(names, lets, x))
+    finally:
+        for i, s in zip(names, saved):
+            set_symbol(i, s)  # type: ignore[arg-type]
+
+def run_repeat(inst: StmtRepeat, n: int) -> None:
+    names = pure_lets(inst.body)
+    c: Cycles | None = None
+    i = 0
+    while i < n:
+        for p in inst.body:
+            interpret_stmt(p)
+        i += 1
+        if names is None:
+            continue
+        state = loop_state(names)
+        if c is None:
+            c = Cycles(state)
+        elif c.add(state):
+            if pure_lets(inst.body) is None:  # The body made a global that one of its functions writes
+                pass
+            elif ip.tracer is not None:
+                mu, x = loop_entry(names, [(p.name, p.expr) for p in inst.body if isinstance(p, StmtLet)], c)
+                ip.tracer.emit(TraceEvent("cycle", " ".join(names), c.length, x, SExprSymbol(str(mu + 1))))
+            else:  # The trace must show every step, so only untraced loops skip them
+                n = i + (n - i) % c.length
+            names = None
+
+def run_fix(inst: StmtFix) -> None:
+    c: Cycles | None = None
+    pure = is_pure_expr(inst.expr, set())
+    while True:
+        v = interpret_expr_extra(inst.expr, False, inst.expr.token)
+        if not fix_step(inst, v):
+            break
+        if not pure:
+            continue
+        if c is None:
+            c = Cycles(v)
+        elif c.add(v):
+            if not is_pure_expr(inst.expr, set()):  # The first step made a global that it writes
+                pure = False
+                continue
+            mu, x = loop_entry([inst.name], [(inst.name, inst.expr)], c)
+            raise RuntimeError(f"`fix {inst.name}' never ends: after {mu + 1} steps `{inst.name}' comes back to `{stringify(x)}' every {c.length} steps at {format_loc(inst.token)}")
+
+def repeat_count(e: SExpr, tok: Token) -> int:
+    if isinstance(e, SExprPeano):
+        return e.n
+    if isinstance(e, SExprSymbol) and e.sym.isdecimal():
+        return int(e.sym)
+    raise RuntimeError(f"Expected a number of repetitions but got `{stringify(e)}' at {format_loc(tok)}")
+
+def fix_step(inst: StmtFix, value: SExpr) -> bool:
+    """Binds the next value of a `fix', returns whether it changed."""
+    s = get_symbol(inst.name)
+    if s is not None and s[0] is value:
+        return False
+    interpreter_let(inst.name, value, inst.token)
+    return True
 
 def interpret_stmt(inst: Stmt) -> None:
     if isinstance(inst, StmtLet):
         interpreter_let(inst.name, interpret_expr_extra(inst.expr, False, inst.expr.token), inst.token)
     elif isinstance(inst, StmtUnlink):
-        if inst.name in transformations:
-            del transformations[inst.name]
+        if inst.name in ip.transformations:
+            del ip.transformations[inst.name]
+            del ip.transformation_nets[inst.name]
+            kind = "form"
         elif get_symbol(inst.name):
             del_symbol(inst.name)
+            kind = "symbol"
         elif get_function(inst.name):
             del_function(inst.name)
+            kind = "func"
         else:
             raise RuntimeError(f"Failed to unlink `{inst.name}' at {format_loc(inst.token)}")
+        if kind == "form":
+            forget_memo()
+        if ip.tracer is not None:
+            ip.tracer.emit(TraceEvent("unlink", name=inst.name, output=SExprSymbol(kind)))
     elif isinstance(inst, StmtShow):
-        print(stringify(interpret_expr_extra(inst.expr, False, inst.expr.token)))
+        ip.out.show(interpret_expr_extra(inst.expr, False, inst.expr.token))
     elif isinstance(inst, StmtPrint):
-        print(inst.text)
+        ip.out.text(inst.text)
     elif isinstance(inst, StmtDefFunc):
         set_function(inst.name, (inst.token, inst.arg, inst.stmt, get_context()))
+    elif isinstance(inst, StmtMemo):
+        ip.memo_pragmas[inst.name] = inst.on
+        ip.targets.pop(inst.name, None)
+    elif isinstance(inst, StmtRepeat):
+        run_repeat(inst, repeat_count(interpret_expr_extra(inst.count, False, inst.count.token), inst.token))
+    elif isinstance(inst, StmtFix):
+        run_fix(inst)
     else:
         assert False, f"What is `{inst}'?!?!?!"
 
@@ -321,3 +1822,14 @@ def interpret_program(prog: List[Stmt]) -> None:
         inst = prog[pc]
         interpret_stmt(inst)
         pc += 1
+    ip.out.flush()
+    flush_events()
+
+def interpret_stream(prog: Iterable[Stmt]) -> None:
+    """Runs every statement as soon as `prog' gives it out (see `--stream')."""
+    for inst in prog:
+        interpret_stmt(inst)
+    ip.out.flush()
+    flush_events()
+
+ip = Interpreter()
@@ -1,78 +1,321 @@
 # TODO: document code!!!
-def replace(expr: SExpr, a: Any, b: Any) -> SExpr:
-    if isinstance(expr, SExprSymbol) and expr.sym == a:
-        return b
-    if expr.wr:  # If `expr' is wrapped, it shouldn't be replaced.
-        return expr
-    if isinstance(expr, SExprSymbol):  # if the a parameter `expr' is a symbol that not equal to a parameter `a', it shouldn't be replaced.
-        return expr
-    if isinstance(expr, SExprCall):
-        return SExprCall(expr.token, False, expr.fun, replace(expr.arg, a, b))
-    if isinstance(expr, SExprTuple):
-        return SExprTuple(expr.token, False, [replace(i, a, b) for i in expr.el])
-    assert False, "unreachable"
+def instantiate(rform: SExpr, m: Dict[str, SExpr]) -> SExpr:
+    """Replaces all the variables of `rform' at once. Bound subterms are shared, not copied."""
+    vals: List[SExpr] = []
+    # ('C', fun) and ('T', n) build a node from the values of its children.
+    todo: List[Any] = [rform]
+    while todo:
+        f = todo.pop()
+        if isinstance(f, SExprSymbol):
+            vals.append(m.get(f.sym, f) if f.var else f)
+        elif isinstance(f, SExprCall):
+            todo.append(('C', f.fun))
+            todo.append(f.arg)
+        elif isinstance(f, SExprTuple):
+            todo.append(('T', len(f.el)))
+            todo.extend(reversed(f.el))
+        elif f[0] == 'C':
+            vals.append(SExprCall(f[1], vals.pop()))
+        else:
+            n = f[1]
+            el = vals[len(vals) - n:]
+            del vals[len(vals) - n:]
+            vals.append(SExprTuple(el))
+    return vals[0]
+
+def nonlinear_error(expr: SExpr, name: str, prev: SExpr, tok: Token | None) -> RuntimeError:
+    return RuntimeError(f"The expression `{stringify(expr)}' called `{name}' is incompatible with the expression `{stringify(prev)}' with the same name at {format_loc(tok) if tok else 'Somewhere'}")
 
 def walk(expr: SExpr, form: SExpr, m: Dict[str, SExpr], tok: Token | None = None) -> Dict[str, SExpr]:
-    if isinstance(form, SExprSymbol) and form.sym and form.sym[0].isupper():
-        if form.sym in m and m[form.sym] != expr:
-            raise RuntimeError(f"The expression `{stringify(expr)}' called `{form.sym}' is incompatible with the expression `{stringify(m[form.sym])}' with the same name at {format_loc(tok) if tok else 'Somewhere'}")
-        m[form.sym] = expr
-        return m
-    if isinstance(form, SExprTuple) and isinstance(expr, SExprTuple):
-        if len(form.el) != len(expr.el):
+    todo = [(expr, form)]
+    while todo:
+        expr, form = todo.pop()
+        if isinstance(form, SExprSymbol) and form.var:
+            if form.sym in m and m[form.sym] != expr:
+                raise nonlinear_error(expr, form.sym, m[form.sym], tok)
+            m[form.sym] = expr
+        elif isinstance(form, SExprTuple) and isinstance(expr, SExprTuple):
+            if len(form.el) != len(expr.el):
+                raise RuntimeError(f"The expression `{stringify(expr)}' is incompatible with the format `{stringify(form)}' at {format_loc(tok) if tok else 'Somewhere'}")
+            for i in range(len(expr.el) - 1, -1, -1):
+                todo.append((expr.el[i], form.el[i]))
+        elif not is_compatible(expr, form):
             raise RuntimeError(f"The expression `{stringify(expr)}' is incompatible with the format `{stringify(form)}' at {format_loc(tok) if tok else 'Somewhere'}")
-        for i in range(len(expr.el)):
-            m = walk(expr.el[i], form.el[i], m, tok)
-        return m
-    if not is_compatible(expr, form):
-        raise RuntimeError(f"The expression `{stringify(expr)}' is incompatible with the format `{stringify(form)}' at {format_loc(tok) if tok else 'Somewhere'}")
     return m
 
 def is_compatible(expr: SExpr, form: SExpr) -> bool:
-    if isinstance(form, SExprSymbol) and form.sym and form.sym[0].isupper():
-        return True
-    if isinstance(form, SExprTuple) and isinstance(expr, SExprTuple):
-        if len(form.el) != len(expr.el):
-            return False
-        for i in range(len(expr.el)):
-            if not is_compatible(expr.el[i], form.el[i]):
+    todo = [(expr, form)]
+    while todo:
+        expr, form = todo.pop()
+        if isinstance(form, SExprSymbol) and form.var:
+            continue
+        if isinstance(form, SExprTuple) and isinstance(expr, SExprTuple):
+            if len(form.el) != len(expr.el):
+                return False
+            todo.extend(zip(expr.el, form.el))
+        elif isinstance(form, SExprCall) and isinstance(expr, SExprCall):
+            if form.fun != expr.fun:
                 return False
-        return True
-    elif isinstance(form, SExprCall) and isinstance(expr, SExprCall):
-        return form.fun == expr.fun and is_compatible(form.arg, expr.arg)
-    elif isinstance(form, SExprSymbol) and isinstance(expr, SExprSymbol):
-        return form.sym == expr.sym
-    return False
-
-def wrap(expr: SExpr) -> SExpr:
-    if expr.wr:
-        return expr
-    if isinstance(expr, SExprSymbol):
-        return SExprSymbol(expr.token, True, expr.sym)
-    if isinstance(expr, SExprCall):
-        return SExprCall(expr.token, True, expr.fun, expr.arg)
-    if isinstance(expr, SExprTuple):
-        return SExprTuple(expr.token, True, expr.el)
-    assert False, "unreachable"
-
-def unwrap(expr: SExpr) -> SExpr:
-    if isinstance(expr, SExprSymbol):
-        return SExprSymbol(expr.token, False, expr.sym)
-    if isinstance(expr, SExprCall):
-        return SExprCall(expr.token, False, expr.fun, unwrap(expr.arg))
-    if isinstance(expr, SExprTuple):
-        return SExprTuple(expr.token, False, [unwrap(i) for i in expr.el])
-    assert False, "unreachable"
+            todo.append((form.arg, expr.arg))
+        elif isinstance(form, SExprSymbol) and isinstance(expr, SExprSymbol):
+            if form is not expr:
+                return False
+        else:
+            return False
+    return True
 
 def substitute(expr: SExpr, sform: SExpr, rform: SExpr, tok: Token | None = None) -> SExpr:
-    m = walk(expr, sform, {}, tok)
-    for r in m:
-        rform = replace(rform, r, wrap(m[r]))
-    rform = unwrap(rform)
-    return rform
-
-def substitute_compatible(expr: SExpr, forms: List[Tuple[SExpr, SExpr]], tok: Token | None = None) -> SExpr:
-    for s, r in forms:
-        if is_compatible(expr, s):
-            return substitute(expr, s, r, tok)
-    raise RuntimeError(f"The expression `{stringify(expr)}' is incompatible with any format in this list: {';'.join(stringify(i[0]) for i in forms)} at {format_loc(tok) if tok else 'Somewhere'}")
+    return instantiate(rform, walk(expr, sform, {}, tok))
+
+# A discrimination net over all the rules of one transformation.
+# Every pattern is flattened in preorder into a path of keys:
+#   ('T', n)   - a tuple with n elements,
+#   ('S', sym) - a constant symbol,
+#   ('C', fun) - a call (its argument is checked by `is_compatible' at the leaf),
+#   None       - a variable, it matches a whole subterm.
+# Patterns with common prefixes share nodes, so a call walks the input once
+# instead of once per rule. The smallest rule index wins, as in `substitute_compatible'.
+
+class RuleNetNode:
+    __slots__ = ("edges", "var", "rules", "low", "shape", "calls")
+
+    def __init__(self) -> None:
+        self.edges: Dict[Any, 'RuleNetNode'] = {}
+        self.var: 'RuleNetNode' | None = None
+        self.rules: List[int] = []
+        self.low = -1
+        self.shape = -1  # The first rule with a tuple or a constant symbol here, a call here must be forced for it.
+        self.calls = -1  # The first rule with a call here, a call here must be evaluated as without `--lazy' for it.
+
+def is_pattern_var(form: SExpr) -> bool:
+    return isinstance(form, SExprSymbol) and form.var
+
+class RuleNet:
+    name: str
+    forms: List[Tuple[SExpr, SExpr]]
+    locs: List[Token | None]
+    verify: List[bool]
+    nonlinear: List[bool]  # Whether a variable occurs more than once in the pattern.
+    compiled: List[Callable[[SExpr, Token | None], SExpr | None] | None]
+    root: RuleNetNode
+
+    def __init__(self, forms: List[Tuple[SExpr, SExpr]] | None = None, name: str = "<rules>") -> None:
+        self.name = name
+        self.forms = []
+        self.locs = []
+        self.verify = []
+        self.nonlinear = []
+        self.compiled = []
+        self.root = RuleNetNode()
+        for s, r in forms or []:
+            self.add(s, r)
+
+    def add(self, sform: SExpr, rform: SExpr, tok: Token | None = None) -> None:
+        idx = len(self.forms)
+        self.forms.append((sform, rform))
+        self.locs.append(tok)
+        self.verify.append(False)
+        self.nonlinear.append(False)
+        self.compiled.append(None)
+        node = self.root
+        todo = [sform]
+        names: Set[str] = set()
+        while True:
+            if node.low == -1:
+                node.low = idx
+            if not todo:
+                break
+            form = todo.pop()
+            if is_pattern_var(form):
+                assert isinstance(form, SExprSymbol)
+                if form.sym in names:
+                    self.nonlinear[idx] = True
+                names.add(form.sym)
+                if node.var is None:
+                    node.var = RuleNetNode()
+                node = node.var
+                continue
+            if isinstance(form, SExprTuple):
+                key: Any = ('T', len(form.el))
+                todo.extend(reversed(form.el))
+            elif isinstance(form, SExprSymbol):
+                key = form  # Symbols are interned, the symbol itself is the key.
+            elif isinstance(form, SExprCall):
+                key = ('C', form.fun)
+                self.verify[idx] = True
+                if node.calls == -1:
+                    node.calls = idx
+            else:
+                assert False, "unreachable"
+            if not isinstance(form, SExprCall) and node.shape == -1:
+                node.shape = idx
+            if key not in node.edges:
+                node.edges[key] = RuleNetNode()
+            node = node.edges[key]
+        node.rules.append(idx)
+
+    def copy(self) -> 'RuleNet':
+        """A net with the same rules, the compiled ones are reused."""
+        r = RuleNet(name=self.name)
+        for (s, rf), tok in zip(self.forms, self.locs):
+            r.add(s, rf, tok)
+        r.compiled = list(self.compiled)
+        return r
+
+    def match(self, expr: SExpr, tried: List[int] | None = None, demands: List[Tuple[int, SExpr, bool]] | None = None) -> int:
+        """Returns the index of the first compatible rule or -1. The rules checked at the leaves are added to `tried'.
+        The calls that hide the shape a rule wants are added to `demands' with the index of that rule and False,
+        the calls that a rule matches as calls with True (see `lazy_demand')."""
+        best = len(self.forms)
+        # The rest of the input is a linked list of subterms: (term, rest) or None.
+        stack: List[Tuple[RuleNetNode, Any]] = [(self.root, (expr, None))]
+        while stack:
+            node, todo = stack.pop()
+            if node.low >= best:
+                continue
+            if todo is None:
+                for r in node.rules:
+                    if r >= best:
+                        break
+                    if tried is not None:
+                        tried.append(r)
+                    if not self.verify[r] or is_compatible(expr, self.forms[r][0]):
+                        best = r
+                        break
+                continue
+            term, rest = todo
+            if isinstance(term, SExprTuple):
+                child = node.edges.get(('T', len(term.el)))
+                if child is not None:
+                    for i in reversed(term.el):
+                        rest = (i, rest)
+            elif isinstance(term, SExprSymbol):
+                child = node.edges.get(term)
+            elif isinstance(term, SExprCall):
+                child = node.edges.get(('C', term.fun))
+                if demands is not None:
+                    if node.shape != -1 and node.shape < best:
+                        demands.append((node.shape, term, False))
+                    if node.calls != -1 and node.calls < best:
+                        demands.append((node.calls, term, True))
+            else:
+                assert False, "unreachable"
+            var = node.var
+            # The branch with the smaller rule index is explored first.
+            if child is None:
+                if var is not None:
+                    stack.append((var, todo[1]))
+            elif var is None:
+                stack.append((child, rest))
+            elif var.low < child.low:
+                stack.append((child, rest))
+                stack.append((var, todo[1]))
+            else:
+                stack.append((var, todo[1]))
+                stack.append((child, rest))
+        return best if best < len(self.forms) else -1
+
+    def compiled_rule(self, i: int) -> Callable[[SExpr, Token | None], SExpr | None]:
+        f = self.compiled[i]
+        if f is None:
+            s, r = self.forms[i]
+            f = self.compiled[i] = compile_rule(s, r)
+        return f
+
+# Rule engines:
+#   generic - `walk' + `substitute' on every call,
+#   codegen - every rule is compiled by `compile_rule' into its own function,
+#   check   - both, the results are compared (a differential test of `compile_rule').
+
+def compile_rule(sform: SExpr, rform: SExpr) -> Callable[[SExpr, Token | None], SExpr | None]:
+    """Generates a function that matches `sform', binds the variables and builds `rform' in one pass.
+    It returns None if the expression doesn't match."""
+    env: Dict[str, Any] = {
+        "SExprSymbol": SExprSymbol,
+        "SExprCall": SExprCall,
+        "SExprTuple": SExprTuple,
+        "is_compatible": is_compatible,
+        "nonlinear_error": nonlinear_error,
+    }
+    def const(v: Any) -> str:
+        n = f"c{len(env)}"
+        env[n] = v
+        return n
+    lines = ["def rule(e, tok):"]
+    checks: List[str] = []
+    binds: Dict[str, str] = {}
+    vc = 0
+    stack: List[Tuple[SExpr, str]] = [(sform, "e")]
+    while stack:
+        form, v = stack.pop()
+        if is_pattern_var(form):
+            assert isinstance(form, SExprSymbol)
+            if form.sym in binds:
+                checks.append(f"    if {v} != {binds[form.sym]}: raise nonlinear_error({v}, {form.sym!r}, {binds[form.sym]}, tok)")
+            else:
+                binds[form.sym] = v
+        elif isinstance(form, SExprTuple):
+            lines.append(f"    if not isinstance({v}, SExprTuple) or len({v}.el) != {len(form.el)}: return None")
+            names = []
+            for i in form.el:
+                vc += 1
+                names.append(f"e{vc}")
+            if names:
+                lines.append(f"    {', '.join(names)}, = {v}.el")
+            stack.extend(reversed(list(zip(form.el, names))))
+        elif isinstance(form, SExprSymbol):
+            lines.append(f"    if {v} is not {const(form)}: return None")
+        elif isinstance(form, SExprCall):
+            lines.append(f"    if not isinstance({v}, SExprCall) or not is_compatible({v}, {const(form)}): return None")
+        else:
+            assert False, "unreachable"
+    lines.extend(checks)
+    def uses_vars(form: SExpr) -> bool:
+        if isinstance(form, SExprSymbol):
+            return form.sym in binds
+        if isinstance(form, SExprCall):
+            return uses_vars(form.arg)
+        if isinstance(form, SExprTuple):
+            return any(uses_vars(i) for i in form.el)
+        assert False, "unreachable"
+    def build(form: SExpr) -> str:
+        if isinstance(form, SExprSymbol) and form.sym in binds:
+            return binds[form.sym]
+        if not uses_vars(form):  # Constant parts of the result are shared between calls.
+            return const(form)
+        if isinstance(form, SExprCall):
+            return f"SExprCall({form.fun!r}, {build(form.arg)})"
+        if isinstance(form, SExprTuple):
+            return f"SExprTuple(({''.join(build(i) + ', ' for i in form.el)}))"
+        assert False, "unreachable"
+    lines.append(f"    return {build(rform)}")
+    exec(compile("\n".join(lines) + "\n", f"<form {stringify(sform)} -> {stringify(rform)}>", "exec"), env)
+    return env["rule"]
+
+def substitute_compatible(expr: SExpr, net: RuleNet, tok: Token | None = None) -> SExpr:
+    if ip.profiler is not None:
+        return profiled_substitute(expr, net, tok)
+    i = net.match(expr)
+    if i != -1:
+        res = apply_rule(expr, net, i, tok)
+        if ip.tracer is not None:
+            ip.tracer.emit(TraceEvent("rule", net.name, i, expr, res))
+        return res
+    raise no_rule_error(expr, net, tok)
+
+def apply_rule(expr: SExpr, net: RuleNet, i: int, tok: Token | None = None) -> SExpr:
+    """Rewrites `expr' by the rule `i' of `net', the rule must be compatible."""
+    s, r = net.forms[i]
+    if ip.rule_engine == "generic":
+        return substitute(expr, s, r, tok)
+    res = net.compiled_rule(i)(expr, tok)
+    if res is None:
+        return substitute(expr, s, r, tok)
+    if ip.rule_engine == "check":
+        ref = substitute(expr, s, r, tok)
+        if ref != res:
+            raise AssertionError(f"Compiled rule `{stringify(s)} -> {stringify(r)}' gives `{stringify(res)}' instead of `{stringify(ref)}' for `{stringify(expr)}'")
+    return res
+
+def no_rule_error(expr: SExpr, net: RuleNet, tok: Token | None) -> RuntimeError:
+    return RuntimeError(f"The expression `{stringify(expr)}' is incompatible with any format in this list: {';'.join(stringify(i[0]) for i in net.forms)} at {format_loc(tok) if tok else 'Somewhere'}")
@@ -2,13 +2,129 @@
 "$!include logicx.py"
 "$!include parserx.py"
 "$!include interpretatorx.py"
+"$!include batchx.py"
+import os
 import sys
 
-if len(sys.argv) != 2:
-    print(f"{sys.argv[0]}: Usage: <script file>", file=sys.stderr)
-    sys.exit(1)
+def main() -> None:
+    usage = f"{sys.argv[0]}: Usage: [--engine=generic|codegen|check] [--eval=recursive|stack] [--memo] [--memo-size=N] [--cache] [--include-once] [--stream] [--lazy] [--parallel[=N]] [--parallel-min=SIZE] [--output=text|lp|binary] [--flush=line|block] [--buffer=N] [--profile[=FILE.json]] [--trace=FILE.jsonl] <script file | ->\n" \
+            f"       {sys.argv[0]} --batch [--jobs=N] [--prelude=FILE] [options] <script file... | ->"
+    files: List[str] = []
+    # With `--stream' every statement runs as soon as it's parsed, so a form is visible
+    # only to the statements after it. `-' reads the script from the standard input.
+    stream = False
+    profile_json: str | None = None
+    traces: List[TextIO] = []  # The `--trace' files, closed after the last events are written.
+    # With `--batch' every file, or every line of the standard input, runs separately (see `run_batch').
+    batch = False
+    jobs = os.cpu_count() or 1
+    prelude: str | None = None
+    # The output is written after every statement to a terminal and in blocks of `--buffer' characters otherwise.
+    flush_mode: str | None = None
+    for a in sys.argv[1:]:
+        if a.startswith("--engine="):
+            ip.rule_engine = a[len("--engine="):]
+            if ip.rule_engine not in ("generic", "codegen", "check"):
+                print(usage, file=sys.stderr)
+                sys.exit(1)
+        elif a.startswith("--eval="):
+            ip.evaluator = a[len("--eval="):]
+            if ip.evaluator not in ("recursive", "stack"):
+                print(usage, file=sys.stderr)
+                sys.exit(1)
+        elif a == "--memo":
+            ip.memo_default = True
+        elif a.startswith("--memo-size=") and a[len("--memo-size="):].isdigit():
+            ip.memo_cache.limit = int(a[len("--memo-size="):])
+        elif a == "--cache":
+            ip.include_cache = True
+        elif a == "--include-once":
+            ip.include_once = True
+        elif a == "--stream":
+            stream = True
+        elif a == "--lazy":
+            ip.lazy = True
+        elif a == "--profile" or a.startswith("--profile="):
+            ip.profiler = Profiler()
+            profile_json = a[len("--profile="):] or None
+        elif a.startswith("--trace=") and len(a) > len("--trace="):
+            traces.append(open(a[len("--trace="):], "w"))
+            subscribe(TraceWriter(traces[-1]), 4096)
+        elif a == "--parallel" or a.startswith("--parallel=") and a[len("--parallel="):].isdigit():
+            ip.parallel = int(a[len("--parallel="):] or os.cpu_count() or 1)
+        elif a.startswith("--parallel-min=") and a[len("--parallel-min="):].isdigit():
+            ip.parallel_min = int(a[len("--parallel-min="):])
+        elif a.startswith("--output="):
+            ip.out.fmt = a[len("--output="):]
+            if ip.out.fmt not in ("text", "lp", "binary"):
+                print(usage, file=sys.stderr)
+                sys.exit(1)
+        elif a.startswith("--flush="):
+            flush_mode = a[len("--flush="):]
+            if flush_mode not in ("line", "block"):
+                print(usage, file=sys.stderr)
+                sys.exit(1)
+        elif a.startswith("--buffer=") and a[len("--buffer="):].isdigit():
+            ip.out.limit = int(a[len("--buffer="):])
+        elif a == "--batch":
+            batch = True
+        elif a.startswith("--jobs=") and a[len("--jobs="):].isdigit():
+            jobs = max(1, int(a[len("--jobs="):]))
+        elif a.startswith("--prelude=") and len(a) > len("--prelude="):
+            prelude = a[len("--prelude="):]
+        elif a.startswith("--"):
+            print(usage, file=sys.stderr)
+            sys.exit(1)
+        else:
+            files.append(a)
 
-c = open(sys.argv[1], "r").read()
-l = lexer(c, sys.argv[1])
-instructions = parse_program(ParseEnv(PeekableSequence(l)))
-interpret_program(instructions)
+    ip.out.flush_mode = flush_mode or ("line" if sys.stdout.isatty() else "block")
+
+    if batch:
+        if not files or ip.out.fmt == "binary" or "-" in files and len(files) != 1 or stream or ip.profiler is not None or ip.tracer is not None:
+            print(usage, file=sys.stderr)
+            sys.exit(1)
+        if files[0] == "-":
+            tasks: List[Tuple[str, str | None]] = [(f"<stdin>:{i + 1}", l) for i, l in enumerate(sys.stdin.read().split("\n")) if l.strip()]
+        else:
+            tasks = [(p, None) for p in files]
+        opts: Dict[str, Any] = {k: getattr(ip, k) for k in ("rule_engine", "evaluator", "memo_default", "include_cache", "include_once")}
+        opts["memo_size"] = ip.memo_cache.limit
+        opts["out"] = OutputSink(ip.out.fmt, "block", ip.out.limit)
+        if not run_batch(tasks, prelude, opts, jobs):
+            sys.exit(1)
+        return
+
+    if len(files) != 1:
+        print(usage, file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        if stream and files[0] == "-":
+            interpret_stream(iter_program(ParseEnv(PeekableIterator(lex_stream(sys.stdin, "<stdin>")))))
+        elif stream:
+            with open(files[0], "r") as f:
+                interpret_stream(iter_program(ParseEnv(PeekableIterator(lex_stream(f, files[0])))))
+        else:
+            c = sys.stdin.read() if files[0] == "-" else read_source(files[0])
+            l = lexer(c, "<stdin>" if files[0] == "-" else files[0])
+            instructions = parse_program(ParseEnv(PeekableSequence(l)))
+            interpret_program(instructions)
+    finally:
+        ip.close()
+        flush_events()
+        for t in traces:
+            t.close()
+        if ip.profiler is not None and profile_json is not None:
+            ip.profiler.dump(profile_json)  # Before the output, the reader may be gone already.
+        try:
+            ip.out.flush()
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reader closed the pipe (`bench.py' does after enough lines), the rest of the output is dropped.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        if ip.profiler is not None:
+            ip.profiler.report(sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,108 +1,155 @@
+def read_source(path: str) -> str:
+    """Reads a script like `open(path, "r").read()', but through `mmap' when the file can be mapped."""
+    enc = locale.getpreferredencoding(False)
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                text = str(m, enc)
+        except (ValueError, OSError):  # Empty files and pipes can't be mapped.
+            text = f.read().decode(enc)
+    if '\r' in text:  # Universal newlines, as in the text mode.
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+# Groups: whitespace, newline, comment, symbol, a run of punctuation, "`[", "`", "->" and a string without escapes.
+_lex_re = re.compile(r"([^\S\n]+)|(\n)|(//[^\n]*\n?)|(\w+)|([()\[\]{}:=]+)|(`\[)|(`)|(->)|('[^'\\\n]*')")
+
+# Token kinds as they are stored in `TokenBuffer.kinds'.
+_lex_punct = {
+    '(': TokenKind.LPAREN.value,
+    ')': TokenKind.RPAREN.value,
+    '[': TokenKind.LBRACK.value,
+    ']': TokenKind.RBRACK.value,
+    '{': TokenKind.LBRACE.value,
+    '}': TokenKind.RBRACE.value,
+    ':': TokenKind.COLON.value,
+    '=': TokenKind.EQUAL.value,
+}
+_lex_symbol = TokenKind.SYMBOL.value
+
+_lex_escapes = {
+    '\\': '\\',
+    'n': '\n',
+    '\'': '\'',
+    't': '\t',
+    'v': '\v',
+    'e': '\x1b',
+}
+
+def lex_string(text: str, i: int, x: int, y: int) -> Tuple[str, int, int, int]:
+    """Lexes the string at `text[i]' char by char, for the strings with escapes and the broken ones.
+    Returns the string, the index and the column after it and the column of its first char."""
+    ltext = len(text)
+    s: List[str] = []
+    x += 1
+    i += 1
+    sx = x
+    while i < ltext and text[i] != '\'' and text[i] != '\n':
+        if text[i] == '\\':
+            i += 1
+            x += 1
+            if i >= ltext:
+                raise SyntaxError(f"Unexpected EOF after string at {y+1}:{x}")
+            if text[i] == 'x':
+                assert False, "TBD"
+            s.append(_lex_escapes.get(text[i], '\\'+text[i]))
+        else:
+            s.append(text[i])
+        i += 1
+        x += 1
+    if i >= ltext:
+        raise SyntaxError(f"Expected `\\'' but got EOF after string at {y+1}:{x}")
+    if text[i] != '\'':
+        raise SyntaxError(f"Expected `\\'' but got `{text[i]}' after string at {y+1}:{x}")
+    return ''.join(s), i + 1, x + 1, sx
+
 def lexer(text: str, filepath: str) -> Sequence[Token]:
-    tokens: List[Token] = []
+    tokens = TokenBuffer(filepath)
+    y, x = lex_text(tokens, text, 0, 0)
+    tokens.add(TokenKind.EOF, y, x)
+    return tokens
+
+def lex_stream(f: Iterable[str], filepath: str) -> Iterator[Token]:
+    """Lexes the lines of `f' lazily. Only the current line is kept, or several lines if a string goes on after an escaped newline."""
+    y = 0
+    x = 0
+    text = ""
+    for line in f:
+        text += line
+        tokens = TokenBuffer(filepath)
+        try:
+            ny, nx = lex_text(tokens, text, y, x)
+        except SyntaxError as err:
+            if "EOF after string" in str(err):  # The string goes on in the next line.
+                continue
+            raise
+        yield from tokens
+        y, x = ny, nx
+        text = ""
+    tokens = TokenBuffer(filepath)
+    if text:
+        y, x = lex_text(tokens, text, y, x)
+    tokens.add(TokenKind.EOF, y, x)
+    yield from tokens
+
+def lex_text(tokens: TokenBuffer, text: str, y: int, x: int) -> Tuple[int, int]:
+    """Appends the tokens of `text', which starts at row `y' and column `x', to `tokens'. Returns the position after it."""
+    kinds = tokens.kinds.append
+    rows = tokens.rows.append
+    cols = tokens.cols.append
+    syms = tokens.syms.append
+    str_ids = tokens.str_ids
+    match = _lex_re.match
     i = 0
     ltext = len(text)
-    x = 0
-    y = 0
     while i < ltext:
-        c = text[i]
-        if c == '(':
-            tokens.append(Token(TokenKind.LPAREN, y, x, filepath))
-            x += 1
-        elif c == ')':
-            tokens.append(Token(TokenKind.RPAREN, y, x, filepath))
-            x += 1
-        elif c == '[':
-            tokens.append(Token(TokenKind.LBRACK, y, x, filepath))
-            x += 1
-        elif c == ']':
-            tokens.append(Token(TokenKind.RBRACK, y, x, filepath))
-            x += 1
-        elif c == '{':
-            tokens.append(Token(TokenKind.LBRACE, y, x, filepath))
-            x += 1
-        elif c == '}':
-            tokens.append(Token(TokenKind.RBRACE, y, x, filepath))
-            x += 1
-        elif c == ':':
-            tokens.append(Token(TokenKind.COLON,  y, x, filepath))
-            x += 1
-        elif c == '=':
-            tokens.append(Token(TokenKind.EQUAL,  y, x, filepath))
-            x += 1
-        elif c == '`':
-            if i + 1 < ltext and text[i + 1] == '[':
-                tokens.append(Token(TokenKind.GRAVE_LPAREN, y, x, filepath))
-                x += 1
-                i += 1
-            else:
-                tokens.append(Token(TokenKind.GRAVE, y, x, filepath))
-            x += 1
-        elif c == '\'':
-            s = ""
-            x += 1
-            i += 1
-            sx = x
-            while i < ltext and text[i] != '\'' and text[i] != '\n':
-                if text[i] == '\\':
-                    i += 1
-                    x += 1
-                    if i >= ltext:
-                        raise SyntaxError(f"Unexpected EOF after string at {y+1}:{x}")
-                    if text[i] == '\\':
-                        s += '\\'
-                    elif text[i] == 'n':
-                        s += '\n'
-                    elif text[i] == '\'':
-                        s += '\''
-                    elif text[i] == 't':
-                        s += '\t'
-                    elif text[i] == 'v':
-                        s += '\v'
-                    elif text[i] == 'e':
-                        s += '\x1b'
-                    elif text[i] == 'x':
-                        assert False, "TBD"
-                    else:
-                        s += '\\'+text[i]
-                else:
-                    s += text[i]
-                i += 1
-                x += 1
-            if i >= ltext:
-                raise SyntaxError(f"Expected `\\'' but got EOF after string at {y+1}:{x}")
-            if text[i] != '\'':
-                raise SyntaxError(f"Expected `\\'' but got `{text[i]}' after string at {y+1}:{x}")
-            x += 1
-            tokens.append(Token(TokenKind.STRING, y, sx, filepath, s))
-        elif c == '/' and i+1 < ltext and text[i+1] == '/':
-            while i < ltext and text[i] != '\n':
-                i += 1
-            x = 0
-            y += 1
-        elif c == '-' and i+1 < ltext and text[i+1] == '>':
-            tokens.append(Token(TokenKind.ARROW, y, x, filepath))
-            x += 2
-            i += 1
-        elif c.isalnum() or c == "_":
-            s = ""
-            sx = x
-            while i < ltext and (text[i].isalnum() or text[i] == "_"):
-                s += text[i]
-                i += 1
-                x += 1
-            i -= 1
-            tokens.append(Token(TokenKind.SYMBOL, y, sx, filepath, s))
-        elif c == '\n':
+        m = match(text, i)
+        if m is None:
+            if text[i] == '\'':
+                s, i, nx, sx = lex_string(text, i, x, y)
+                tokens.add(TokenKind.STRING, y, sx, s)
+                x = nx
+                continue
+            raise SyntaxError(f"Unexpected symbol `{text[i]}' at {y+1}:{x}")
+        g = m.lastindex
+        j = m.end()
+        if g == 1:
+            x += j - i
+        elif g == 2 or g == 3:
             y += 1
             x = 0
-        elif c.isspace():
+        elif g == 4:
+            s = m.group()
+            k = str_ids.get(s)
+            if k is None:
+                k = str_ids[s] = len(tokens.strs)
+                tokens.strs.append(s)
+            kinds(_lex_symbol)
+            rows(y)
+            cols(x)
+            syms(k)
+            x += j - i
+        elif g == 5:  # A run of punctuation.
+            for c in text[i:j]:
+                kinds(_lex_punct[c])
+                rows(y)
+                cols(x)
+                syms(-1)
+                x += 1
+        elif g == 6:
+            tokens.add(TokenKind.GRAVE_LPAREN, y, x)
+            x += 2
+        elif g == 7:
+            tokens.add(TokenKind.GRAVE, y, x)
             x += 1
+        elif g == 8:
+            tokens.add(TokenKind.ARROW, y, x)
+            x += 2
         else:
-            raise SyntaxError(f"Unexpected symbol `{c}' at {y+1}:{x}")
-        i += 1    
-    tokens.append(Token(TokenKind.EOF, y, x, filepath))
-    return tokens
+            tokens.add(TokenKind.STRING, y, x + 1, text[i+1:j-1])
+            x += j - i
+        i = j
+    return y, x
 
 
 class ParseEnv:
@@ -175,6 +222,158 @@ def parse_expr(e: ParseEnv) -> Expr | None:
         return t
     return None
 
+def define_form(name: str, ia: SExpr, ib: SExpr, ft: Token) -> None:
+    if name in ip.shared_forms:  # Copy on write, see `Interpreter.fork'.
+        ip.shared_forms.discard(name)
+        if name in ip.meta_transformations:
+            ip.meta_transformations[name] = list(ip.meta_transformations[name])
+            ip.meta_transformation_nets[name] = ip.meta_transformation_nets[name].copy()
+        if name in ip.transformations:
+            ip.transformations[name] = list(ip.transformations[name])
+            ip.transformation_nets[name] = ip.transformation_nets[name].copy()
+    if name not in ip.meta_transformations:
+        ip.meta_transformations[name] = []
+        ip.meta_transformation_nets[name] = RuleNet(name=name + "`")
+    ip.meta_transformations[name].append((ia, ib))
+    ip.meta_transformation_nets[name].add(ia, ib, ft)
+
+    # if inst.name in symbols:
+    #     if symbols[inst.name][1] is not None:
+    #         raise RuntimeError(f"Failed to define transformation `{inst.name}' at {format_loc(inst.token)}\nThis name is already taken by a symbol at {format_loc(symbols[inst.name][1])}")
+    #     else:
+    #         raise RuntimeError(f"Failed to define transformation `{inst.name}' at {format_loc(inst.token)}\nThis name is already taken by a symbol at Somewhere")
+    if name not in ip.transformations:
+        ip.transformations[name] = []
+        ip.transformation_nets[name] = RuleNet(name=name)
+    ip.transformations[name].append((ia, ib, ft))
+    ip.transformation_nets[name].add(ia, ib, ft)
+    for rec in ip.include_recorders:
+        rec.forms.append((name, ia, ib, ft))
+    forget_memo()
+
+def has_ctcall(e: Expr) -> bool:
+    if isinstance(e, ExprCTCall):
+        return True
+    if isinstance(e, ExprCall):
+        return has_ctcall(e.arg)
+    if isinstance(e, ExprQuote):
+        return has_ctcall(e.sentence)
+    if isinstance(e, ExprTuple):
+        return any(has_ctcall(i) for i in e.el)
+    return False
+
+# Included files.
+# With `include_cache' (`--cache') the statements and the forms of an included file are saved
+# to `__mflcache__/NAME.pickle' next to it, like `__pycache__'. The cache is used while every file
+# it was built from has the same size and mtime, or failing that the same content hash.
+# Files whose forms use CT-calls aren't cached: their rules depend on the forms defined before them.
+# With `include_once' (`--include-once') a file that is already loaded in this run is skipped.
+
+INCLUDE_CACHE_VERSION = 1
+
+class IncludeRecord:
+    """What parsing one included file did: the files it read, the forms it defined and the statements it gave."""
+    deps: List[Tuple[str, int, int, str]]  # path, size, mtime, sha256
+    forms: List[Tuple[str, SExpr, SExpr, Token]]
+    stmts: List[Stmt]
+    cacheable: bool
+
+    def __init__(self) -> None:
+        self.deps = []
+        self.forms = []
+        self.stmts = []
+        self.cacheable = True
+
+def cache_path(p: str) -> str:
+    return os.path.join(os.path.dirname(p), "__mflcache__", os.path.basename(p) + ".pickle")
+
+def source_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def dep_is_fresh(dep: Tuple[str, int, int, str]) -> bool:
+    p, size, mtime, h = dep
+    try:
+        st = os.stat(p)
+        if st.st_size == size and st.st_mtime_ns == mtime:
+            return True
+        return source_hash(read_source(p)) == h
+    except OSError:
+        return False
+
+def term_locs(e: SExpr) -> List[Tuple[SExpr, Token]]:
+    """The source locations of `e' and its subterms, they aren't pickled with the terms."""
+    r = []
+    todo = [e]
+    while todo:
+        e = todo.pop()
+        t = sexpr_locs.get(e)
+        if t is not None:
+            r.append((e, t))
+        if isinstance(e, SExprCall):
+            todo.append(e.arg)
+        elif isinstance(e, SExprTuple) and not isinstance(e, SExprPeano):
+            todo.extend(e.el)
+    return r
+
+def load_include(p: str) -> IncludeRecord | None:
+    try:
+        with open(cache_path(p), "rb") as f:
+            version, deps, forms, locs, stmts = pickle.load(f)
+    except Exception:
+        return None
+    if version != INCLUDE_CACHE_VERSION or not all(dep_is_fresh(d) for d in deps):
+        return None
+    if ip.include_once and any(os.path.realpath(d[0]) in ip.included for d in deps[1:]):
+        return None  # It was saved with the files that are skipped now.
+    for t, tok in locs:
+        if t not in sexpr_locs:
+            sexpr_locs[t] = tok
+    rec = IncludeRecord()
+    rec.deps, rec.forms, rec.stmts = deps, forms, stmts
+    return rec
+
+def store_include(p: str, rec: IncludeRecord) -> None:
+    locs = []
+    for _, ia, ib, _ in rec.forms:
+        locs += term_locs(ia) + term_locs(ib)
+    path = cache_path(p)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump((INCLUDE_CACHE_VERSION, rec.deps, rec.forms, locs, rec.stmts), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+def include_file(p: str) -> List[Stmt]:
+    if ip.include_once and os.path.realpath(p) in ip.included:
+        for r in ip.include_recorders:
+            r.cacheable = False
+        return []
+    rec = load_include(p) if ip.include_cache else None
+    if rec is not None:
+        for name, ia, ib, ft in rec.forms:
+            define_form(name, ia, ib, ft)
+    else:
+        rec = IncludeRecord()
+        ip.include_recorders.append(rec)
+        try:
+            c = read_source(p)
+            st = os.stat(p)
+            rec.deps.append((p, st.st_size, st.st_mtime_ns, source_hash(c)))
+            l = lexer(c, p)
+            env = ParseEnv(PeekableSequence(l))
+            rec.stmts = parse_program(env)
+        finally:
+            ip.include_recorders.pop()
+        if ip.include_cache and rec.cacheable:
+            store_include(p, rec)
+    for r in ip.include_recorders:
+        r.deps.extend(rec.deps)
+    for d in rec.deps:
+        ip.included.add(os.path.realpath(d[0]))
+    return rec.stmts
+
 # Dirty code. Yay!!
 
 def parse_stmt(e: ParseEnv) -> List[Stmt] | None:
@@ -205,19 +404,11 @@ def parse_stmt(e: ParseEnv) -> List[Stmt] | None:
         b = parse_expr(e)
         if b is None:
             raise SyntaxError(f"Expected expression at {format_loc(ft)}")
+        if has_ctcall(a) or has_ctcall(b):  # Its result depends on the forms defined before.
+            for rec in ip.include_recorders:
+                rec.cacheable = False
         ia, ib = interpret_expr(a, True, a.token), interpret_expr(b, True, b.token)
-        if name not in meta_transformations:
-            meta_transformations[name] = []
-        meta_transformations[name].append((ia, ib))
-
-        # if inst.name in symbols:
-        #     if symbols[inst.name][1] is not None:
-        #         raise RuntimeError(f"Failed to define transformation `{inst.name}' at {format_loc(inst.token)}\nThis name is already taken by a symbol at {format_loc(symbols[inst.name][1])}")
-        #     else:
-        #         raise RuntimeError(f"Failed to define transformation `{inst.name}' at {format_loc(inst.token)}\nThis name is already taken by a symbol at Somewhere")
-        if name not in transformations:
-            transformations[name] = []
-        transformations[name].append((ia, ib, ft))
+        define_form(name, ia, ib, ft)
         return []  # StmtDefForm(ft, name, ia, ib)] Unnecessary
     if ks == "unlink":
         name = e.expect(TokenKind.SYMBOL).sym
@@ -229,18 +420,36 @@ def parse_stmt(e: ParseEnv) -> List[Stmt] | None:
         if t is None:
             raise SyntaxError(f"Expected expression at {format_loc(ft)}")
         return [StmtShow(k, t)]
+    if ks == "memo" or ks == "nomemo":
+        name = e.expect(TokenKind.SYMBOL).sym
+        assert name is not None
+        return [StmtMemo(k, name, ks == "memo")]
     if ks == "print":
         text = e.expect(TokenKind.STRING).sym
         assert text is not None
         return [StmtPrint(k, text)]
+    if ks == "repeat":
+        ft = e.peek()
+        n = parse_expr(e)
+        if n is None:
+            raise SyntaxError(f"Expected expression at {format_loc(ft)}")
+        e.expect(TokenKind.LBRACE)
+        body = parse_program(e)
+        e.expect(TokenKind.RBRACE)
+        return [StmtRepeat(k, n, body)]
+    if ks == "fix":
+        name = e.expect(TokenKind.SYMBOL).sym
+        assert name is not None
+        e.expect(TokenKind.EQUAL)
+        ft = e.peek()
+        d = parse_expr(e)
+        if d is None:
+            raise SyntaxError(f"Expected expression at {format_loc(ft)}")
+        return [StmtFix(k, name, d)]
     if ks == "include":
         p = e.expect(TokenKind.STRING).sym
         assert p is not None
-        c = open(p, "r").read()
-        l = lexer(c, p)
-        scl = c.split("\n")
-        r = ParseEnv(PeekableSequence(l))
-        return parse_program(r)
+        return include_file(p)
     if ks == "func":
         name = e.expect(TokenKind.SYMBOL).sym
         assert name is not None
@@ -262,10 +471,12 @@ def parse_stmt(e: ParseEnv) -> List[Stmt] | None:
     raise SyntaxError(f"Unknown statement `{ks}' at {format_loc(k)}")
 
 def parse_program(e: ParseEnv) -> List[Stmt]:
-    stmts = []
+    return list(iter_program(e))
+
+def iter_program(e: ParseEnv) -> Iterator[Stmt]:
+    """Parses the statements one by one, a statement is given out as soon as it's complete."""
     while True:
         stmt = parse_stmt(e)
         if stmt is None:
             break
-        stmts.extend(stmt)
-    return stmts
+        yield from stmt